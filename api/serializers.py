@@ -3,7 +3,9 @@ from django.contrib.humanize.templatetags.humanize import naturaltime
 from drf_queryfields import QueryFieldsMixin
 from rest_framework import serializers
 
-from apostello.models import (Keyword, QueuedSms, Recipient, RecipientGroup, SmsInbound, SmsOutbound, UserProfile)
+from apostello.models import (
+    Keyword, QueuedSms, Recipient, RecipientGroup, SendJob, SmsInbound, SmsOutbound, UserProfile
+)
 from elvanto.models import ElvantoGroup
 from site_config.models import DefaultResponses, SiteConfiguration
 
@@ -200,17 +202,33 @@ class UserProfileSerializer(BaseModelSerializer):
         )
 
 
+class RecipientGroupLightSerializer(BaseModelSerializer):
+    """Serialize apostello.models.RecipientGroup without members."""
+
+    class Meta:
+        model = RecipientGroup
+        fields = (
+            'name',
+            'pk',
+            'description',
+            'is_archived',
+        )
+
+
 class QueuedSmsSerializer(BaseModelSerializer):
     """Serialize queued messages"""
     time_to_send_formatted = serializers.SerializerMethodField()
     recipient = serializers.SerializerMethodField()
-    recipient_group = RecipientGroupSerializer(read_only=True)
+    recipient_group = RecipientGroupLightSerializer(read_only=True)
+    recipient_count = serializers.IntegerField(read_only=True)
 
     def get_time_to_send_formatted(self, obj):
         """Next run time in humand friendly format."""
         return naturaltime(obj.time_to_send)
 
     def get_recipient(self, obj):
+        if obj.recipient is None:
+            return None
         recip = RecipientSerializer(instance=obj.recipient, read_only=True, context=self.context)
         return recip.data
 
@@ -225,10 +243,33 @@ class QueuedSmsSerializer(BaseModelSerializer):
             'content',
             'recipient',
             'recipient_group',
+            'recipient_count',
             'sent_by',
         )
 
 
+class SendJobSerializer(BaseModelSerializer):
+    """Serialize group send progress."""
+    recipient_group = serializers.StringRelatedField()
+    progress = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = SendJob
+        fields = (
+            'pk',
+            'content',
+            'sent_by',
+            'recipient_group',
+            'status',
+            'total',
+            'sent',
+            'failed',
+            'progress',
+            'created',
+            'updated',
+        )
+
+
 class SiteConfigurationSerializer(BaseModelSerializer):
     auto_add_new_groups = RecipientGroupSerializer(many=True, read_only=True)
     twilio_from_num = serializers.SerializerMethodField()
@@ -39,7 +39,8 @@ urlpatterns = [
             model_class=m.Recipient,
             form_class=f.RecipientForm,
             serializer_class=s.RecipientSerializer,
-            permission_classes=(IsAuthenticated, p.CanSeeContactNames)
+            permission_classes=(IsAuthenticated, p.CanSeeContactNames),
+            related_field='last_inbound',
         ),
         name='recipients'
     ),
@@ -73,6 +74,16 @@ urlpatterns = [
         ),
         name='queued_smss'
     ),
+    url(
+        r'^v2/send_jobs/(?:(?P<pk>\d+)/)?$',
+        v.Collection.as_view(
+            model_class=m.SendJob,
+            serializer_class=s.SendJobSerializer,
+            permission_classes=(IsAuthenticated, p.IsStaff),
+            related_field='recipient_group',
+        ),
+        name='send_jobs'
+    ),
     url(
         r'^v2/keywords/(?:(?P<keyword>\w+)/)?$',
         v.Collection.as_view(
@@ -117,6 +128,11 @@ urlpatterns = [
         v.ResponsesView.as_view(),
         name='default_responses',
     ),
+    url(
+        r'^v2/logs/sync/$',
+        v.LogSyncView.as_view(),
+        name='log_sync_status',
+    ),
     # simple toggle views:
     url(
         r'^v2/toggle/sms/in/display_on_wall/(?P<pk>[0-9]+)/$',
@@ -159,6 +175,11 @@ urlpatterns = [
         v.SendGroup.as_view(),
         name='act_send_group',
     ),
+    url(
+        r'^v2/actions/sms/cost/$',
+        v.SmsCostPreview.as_view(),
+        name='act_sms_cost_preview',
+    ),
     url(
         r'^v2/actions/sms/in/archive/(?P<pk>[0-9]+)/$',
         v.ArchiveObj.as_view(
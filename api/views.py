@@ -4,6 +4,7 @@ import io
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Count, Q
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 from django.views.generic import View
@@ -19,12 +20,15 @@ from rest_framework.views import APIView
 from api import serializers
 from api.drf_permissions import CanImport, CanSeeKeywords, CanSendSms, IsStaff
 from api.forms import handle_form
+from apostello import logs, segments
 from apostello.forms import (CsvImport, GroupAllCreateForm, SendAdhocRecipientsForm, SendRecipientGroupForm)
 from apostello.mixins import ProfilePermsMixin
-from apostello.models import (Keyword, Recipient, RecipientGroup, SmsInbound, SmsOutbound, CloudMessageId)
+from apostello.models import (
+    Keyword, LogSyncCursor, Recipient, RecipientGroup, SmsInbound, SmsOutbound, CloudMessageId
+)
 from elvanto.models import ElvantoGroup
 from site_config.forms import DefaultResponsesForm, SiteConfigurationForm
-from site_config.models import DefaultResponses, SiteConfiguration
+from site_config.models import ConfigurationError, DefaultResponses, SiteConfiguration
 
 
 class ActionForbidden(Exception):
@@ -68,6 +72,25 @@ class ResponsesView(APIView):
         return handle_form(self, request)
 
 
+class LogSyncView(APIView):
+    """Report the state of the Twilio log reconciliation."""
+    permission_classes = (IsAuthenticated, IsStaff)
+
+    def get(self, request, format=None, **kwargs):
+        cursors = {
+            c.direction: {
+                'last_date': c.last_date,
+                'last_sid': c.last_sid,
+                'last_synced': c.last_synced,
+            }
+            for c in LogSyncCursor.objects.all()
+        }
+        return Response({
+            'next_outgoing_log_check': logs.next_outgoing_log_check(),
+            'cursors': cursors,
+        })
+
+
 class CSVImport(APIView):
     permission_classes = (IsAuthenticated, CanImport)
     form_class = CsvImport
@@ -230,7 +253,11 @@ class SmsCollection(Collection):
 class QueuedSmsCollection(Collection):
     def get_queryset(self):
         """Return only messages that have not been sent"""
-        return self.model_class.objects.all().filter(sent=False)
+        members = Q(recipient_group__recipient__is_archived=False, recipient_group__recipient__is_blocking=False)
+        return self.model_class.objects.all().filter(sent=False).select_related(
+            'recipient__last_inbound',
+            'recipient_group',
+        ).annotate(num_recipients=Count('recipient_group__recipient', filter=members))
 
 
 class ActionObj(APIView):
@@ -487,6 +514,42 @@ class SendGroup(APIView):
         return Response({'messages': [], 'errors': form.errors}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class SmsCostPreview(APIView):
+    """
+    Preview the cost of a send.
+
+    Pass the message as `content` and either a `recipient_group` pk or one
+    or more `recipients` pks. Each recipient's message is personalised
+    before counting segments.
+    """
+    permission_classes = (IsAuthenticated, CanSendSms)
+
+    def get(self, request, format=None, **kwargs):
+        content = request.query_params.get('content', '')
+        group_pk = request.query_params.get('recipient_group')
+        try:
+            if group_pk:
+                group = get_object_or_404(RecipientGroup, pk=int(group_pk))
+                recipients = group.recipient_set.filter(is_archived=False, is_blocking=False)
+            else:
+                pks = [int(pk) for pk in request.query_params.getlist('recipients')]
+                recipients = Recipient.objects.filter(pk__in=pks, is_archived=False, is_blocking=False)
+        except ValueError:
+            return Response({'error': 'Invalid recipient'}, status=status.HTTP_400_BAD_REQUEST)
+
+        name_counts = segments.first_name_counts(recipients)
+        num_segments = segments.total_segments(content, name_counts)
+        try:
+            sending_cost = SiteConfiguration.get_twilio_settings()['sending_cost']
+        except ConfigurationError:
+            sending_cost = 0
+        return Response({
+            'recipients': sum(name_counts.values()),
+            'segments': num_segments,
+            'cost': num_segments * sending_cost,
+        })
+
+
 class CreateAllGroup(APIView):
     """View to handle creation of an 'all' group."""
     permission_classes = (IsAuthenticated, IsStaff)
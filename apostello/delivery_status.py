@@ -0,0 +1,151 @@
+import json
+import time
+from collections import defaultdict
+
+from django_redis import get_redis_connection
+from django_q.tasks import async
+
+from apostello.models import SmsOutbound
+
+# status callbacks waiting to be written to the db
+PENDING_KEY = 'apostello:sms_status:pending'
+# statuses for messages we have not logged yet, Twilio can call back
+# before a batch send has written its messages
+UNMATCHED_KEY = 'apostello:sms_status:unmatched'
+# when each unmatched status arrived, so each one expires on its own
+UNMATCHED_TIMES_KEY = 'apostello:sms_status:unmatched_times'
+UNMATCHED_TTL = 60 * 60 * 24
+# also flush every time this many callbacks have piled up
+FLUSH_EVERY = 100
+FLUSH_BATCH_SIZE = 500
+
+# callbacks can arrive out of order, a status never replaces a later one
+STATUS_RANKS = {
+    'accepted': 0,
+    'queued': 1,
+    'sending': 2,
+    'sent': 3,
+    'delivered': 4,
+    'undelivered': 4,
+    'failed': 4,
+    'read': 5,
+}
+
+
+def _rank(status):
+    return STATUS_RANKS.get(status, -1)
+
+
+def _latest(updates):
+    """The furthest along status for each message."""
+    latest = {}
+    for sid, status in updates:
+        if sid not in latest or _rank(status) >= _rank(latest[sid]):
+            latest[sid] = status
+    return latest
+
+
+def _update_statuses(latest):
+    """Write statuses to the outgoing log, one UPDATE per status."""
+    by_status = defaultdict(list)
+    for sid, status in latest.items():
+        by_status[status].append(sid)
+    num_updated = 0
+    for status, sids in by_status.items():
+        not_before = [s for s, rank in STATUS_RANKS.items() if rank >= _rank(status)]
+        num_updated += SmsOutbound.objects.filter(sid__in=sids).exclude(status__in=not_before).update(status=status)
+    return num_updated
+
+
+def record(sid, status):
+    """
+    Queue a status update from a Twilio callback.
+
+    The first update into an empty queue triggers a flush, so under load a
+    burst of callbacks is written with a handful of queries.
+    """
+    num_pending = get_redis_connection('default').rpush(PENDING_KEY, json.dumps([sid, status]))
+    if num_pending == 1 or num_pending % FLUSH_EVERY == 0:
+        async('apostello.tasks.flush_sms_status_updates')
+
+
+def _pop_pending(conn):
+    pipe = conn.pipeline()
+    pipe.lrange(PENDING_KEY, 0, FLUSH_BATCH_SIZE - 1)
+    pipe.ltrim(PENDING_KEY, FLUSH_BATCH_SIZE, -1)
+    return pipe.execute()[0]
+
+
+def _store_unmatched(conn, unmatched):
+    """Keep statuses for messages not logged yet, unless we have a later one."""
+    sids = list(unmatched)
+    stored = conn.hmget(UNMATCHED_KEY, sids)
+    for sid, old in zip(sids, stored):
+        if old is not None and _rank(old.decode()) > _rank(unmatched[sid]):
+            unmatched[sid] = old.decode()
+    pipe = conn.pipeline()
+    pipe.hmset(UNMATCHED_KEY, unmatched)
+    pipe.zadd(UNMATCHED_TIMES_KEY, **{sid: time.time() for sid in sids})
+    pipe.execute()
+
+
+def flush():
+    """Write queued status updates, one UPDATE per status."""
+    conn = get_redis_connection('default')
+    num_updated = 0
+    while True:
+        pending = _pop_pending(conn)
+        if not pending:
+            return num_updated
+        latest = _latest(json.loads(update) for update in pending)
+        num_updated += _update_statuses(latest)
+
+        found = set(SmsOutbound.objects.filter(sid__in=latest.keys()).values_list('sid', flat=True))
+        unmatched = {sid: status for sid, status in latest.items() if sid not in found}
+        if unmatched:
+            _store_unmatched(conn, unmatched)
+            # the message may have been logged, and apply_unmatched called,
+            # since we looked, so look again now the status is stored
+            num_updated += apply_unmatched(
+                SmsOutbound.objects.filter(sid__in=unmatched.keys()).values_list('sid', flat=True)
+            )
+
+
+def apply_unmatched(sids):
+    """
+    Apply statuses that arrived before these messages were logged.
+
+    Call this after the messages have been saved.
+    """
+    sids = list(sids)
+    if not sids:
+        return 0
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.hmget(UNMATCHED_KEY, sids)
+    pipe.hdel(UNMATCHED_KEY, *sids)
+    pipe.zrem(UNMATCHED_TIMES_KEY, *sids)
+    statuses = pipe.execute()[0]
+    return _update_statuses({sid: status.decode() for sid, status in zip(sids, statuses) if status is not None})
+
+
+def retry_unmatched():
+    """
+    Apply unmatched statuses whose messages have since been logged, and
+    forget those that have been waiting longer than UNMATCHED_TTL.
+
+    Run on a schedule, to catch anything a flush or send missed.
+    """
+    conn = get_redis_connection('default')
+    expired = conn.zrangebyscore(UNMATCHED_TIMES_KEY, '-inf', time.time() - UNMATCHED_TTL)
+    if expired:
+        pipe = conn.pipeline()
+        pipe.hdel(UNMATCHED_KEY, *expired)
+        pipe.zrem(UNMATCHED_TIMES_KEY, *expired)
+        pipe.execute()
+    num_updated = 0
+    waiting = [sid.decode() for sid in conn.hkeys(UNMATCHED_KEY)]
+    for i in range(0, len(waiting), FLUSH_BATCH_SIZE):
+        batch = waiting[i:i + FLUSH_BATCH_SIZE]
+        num_updated += apply_unmatched(SmsOutbound.objects.filter(sid__in=batch).values_list('sid', flat=True))
+    return num_updated
@@ -0,0 +1,77 @@
+"""
+Send queued messages when they are due.
+
+The dispatcher sends whatever is due, then sleeps until the next message
+is due. Scheduling a message wakes it up early, in case the new message is
+due before anything it already knows about.
+"""
+import logging
+import threading
+from math import ceil
+
+from django.db import close_old_connections
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from apostello import sending
+
+logger = logging.getLogger('apostello')
+
+# pushed to when a message is scheduled, the dispatcher blocks on it
+WAKE_KEY = 'apostello:queued_sms:wake'
+# longest the dispatcher sleeps for, so stale claims are picked up again
+MAX_SLEEP = 60
+# seconds to wait after an error, doubled for each error in a row
+BACKOFF = 1
+MAX_BACKOFF = 60
+
+
+def wake():
+    """Wake the dispatcher, a message has been scheduled."""
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.lpush(WAKE_KEY, 1)
+    pipe.ltrim(WAKE_KEY, 0, 0)
+    pipe.execute()
+
+
+def sleep_time(now=None):
+    """Seconds until the next queued message is due, at most MAX_SLEEP."""
+    if now is None:
+        now = timezone.now()
+    due = sending.next_due()
+    if due is None:
+        return MAX_SLEEP
+    return min(max((due - now).total_seconds(), 0), MAX_SLEEP)
+
+
+def run(stop=None):
+    """
+    Send queued messages as they fall due, until `stop` is set.
+
+    Each pass claims only the messages that are due, and between passes
+    the dispatcher blocks on Redis rather than polling the database. An
+    error is logged and the pass tried again after a backoff, so a
+    database or Redis outage does not stop the dispatcher.
+    """
+    if stop is None:
+        stop = threading.Event()
+    conn = get_redis_connection('default')
+    errors = 0
+    while not stop.is_set():
+        # this is not a request, so tidy up stale connections ourselves
+        close_old_connections()
+        try:
+            num_claimed = sending.dispatch_queued()
+            if num_claimed:
+                logger.info('Dispatched %s queued sms', num_claimed)
+            # Redis only takes whole seconds, and anything still due now is
+            # being sent by another worker
+            conn.brpop(WAKE_KEY, timeout=max(ceil(sleep_time()), 1))
+        except Exception:
+            errors += 1
+            backoff = min(BACKOFF * 2**(errors - 1), MAX_BACKOFF)
+            logger.exception('Dispatcher failed, trying again in %s seconds', backoff)
+            stop.wait(backoff)
+        else:
+            errors = 0
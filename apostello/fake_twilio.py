@@ -0,0 +1,158 @@
+"""
+In-process stand in for Twilio.
+
+Set `SMS_BACKEND = 'apostello.fake_twilio.FakeClient'` to send and receive
+without touching Twilio, e.g. for load tests or offline staging. Sent
+messages are kept in memory. Inbound messages and delivery callbacks are
+replayed against our own webhooks, signed like Twilio would sign them.
+"""
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.test import RequestFactory
+from django.utils import timezone
+from twilio.base.exceptions import TwilioRestException
+from twilio.request_validator import RequestValidator
+
+
+class FakeMessage:
+    """Looks enough like twilio's MessageInstance for our needs."""
+
+    def __init__(self, body, to, from_, direction, status, status_callback=None):
+        self.sid = 'SM' + uuid.uuid4().hex
+        self.body = body
+        self.to = to
+        self.from_ = from_
+        self.direction = direction
+        self.status = status
+        self.status_callback = status_callback
+        self.date_created = timezone.now()
+        self.date_sent = self.date_created
+
+    def __repr__(self):
+        return f'<FakeMessage {self.sid} {self.from_} -> {self.to}>'
+
+
+class FakeMessageContext:
+    def __init__(self, messages, sid):
+        self._messages = messages
+        self._sid = sid
+
+    def fetch(self):
+        try:
+            return self._messages.by_sid[self._sid]
+        except KeyError:
+            raise TwilioRestException(404, self._sid, msg='The requested resource was not found', code=20404)
+
+
+class FakeMessages:
+    """The `messages` resource, keeps every message in memory."""
+
+    def __init__(self, client):
+        self.client = client
+        self.sent = []
+        self.by_sid = {}
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._random = random.Random(0)
+
+    def __call__(self, sid):
+        return FakeMessageContext(self, sid)
+
+    def _check_rate(self):
+        if not settings.FAKE_SMS_RATE_LIMIT:
+            return
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > 1:
+            self._recent.popleft()
+        if len(self._recent) >= settings.FAKE_SMS_RATE_LIMIT:
+            raise TwilioRestException(429, 'Messages.json', msg='Too Many Requests', code=20429)
+        self._recent.append(now)
+
+    def add(self, msg):
+        with self._lock:
+            self.sent.append(msg)
+            self.by_sid[msg.sid] = msg
+        return msg
+
+    def create(self, body=None, to=None, from_=None, status_callback=None):
+        if settings.FAKE_SMS_LATENCY:
+            time.sleep(settings.FAKE_SMS_LATENCY)
+        with self._lock:
+            self._check_rate()
+            failed = self._random.random() < settings.FAKE_SMS_ERROR_RATE
+        if failed:
+            raise TwilioRestException(400, 'Messages.json', msg='Fake delivery failure', code=30008)
+        return self.add(FakeMessage(body, to, from_, 'outbound-api', 'queued', status_callback=status_callback))
+
+    def stream(self, to=None, from_=None, date_sent_after=None, date_sent_before=None, **kwargs):
+        with self._lock:
+            msgs = list(reversed(self.sent))
+        for msg in msgs:
+            if to is not None and msg.to != to:
+                continue
+            if from_ is not None and msg.from_ != from_:
+                continue
+            if date_sent_after is not None and msg.date_sent.date() < date_sent_after:
+                continue
+            if date_sent_before is not None and msg.date_sent.date() > date_sent_before:
+                continue
+            yield msg
+
+    def list(self, **kwargs):
+        return list(self.stream(**kwargs))
+
+
+class FakeClient:
+    """Drop in replacement for `twilio.rest.Client`."""
+
+    def __init__(self, sid, auth_token):
+        self.username = sid
+        self.password = auth_token
+        self.messages = FakeMessages(self)
+
+    def _post(self, view, path, data):
+        """Call one of our Twilio webhooks, as Twilio would."""
+        factory = RequestFactory(SERVER_NAME=_host())
+        url = 'http://{0}{1}'.format(_host(), path)
+        signature = RequestValidator(self.password).compute_signature(url, data)
+        request = factory.post(path, data=data, HTTP_X_TWILIO_SIGNATURE=signature)
+        return view(request)
+
+    def receive(self, from_, body, to=None):
+        """Replay an inbound sms against `apostello.views.sms.sms`."""
+        from apostello.views.sms import sms
+        from site_config.models import SiteConfiguration
+        to = to or str(SiteConfiguration.get_solo().twilio_from_num)
+        msg = self.messages.add(FakeMessage(body, to, from_, 'inbound', 'received'))
+        data = {
+            'MessageSid': msg.sid,
+            'SmsSid': msg.sid,
+            'SmsMessageSid': msg.sid,
+            'AccountSid': self.username,
+            'From': from_,
+            'To': to,
+            'Body': body,
+            'NumMedia': '0',
+            'SmsStatus': 'received',
+            'ApiVersion': '2010-04-01',
+        }
+        return self._post(sms, '/sms/', data)
+
+    def deliver(self, sid, status='delivered'):
+        """Replay a delivery status callback for a sent message."""
+        from apostello.views.sms import sms_status
+        msg = self.messages.by_sid[sid]
+        msg.status = status
+        return self._post(sms_status, '/sms/status/', {'MessageSid': sid, 'MessageStatus': status})
+
+
+def _host():
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*' and not host.startswith('.'):
+            return host
+    return 'localhost'
@@ -0,0 +1,85 @@
+import threading
+import time
+
+from django.core.cache import cache
+
+# cache key shared by all processes, bumped whenever a keyword changes
+VERSION_KEY = 'keyword_index_version'
+
+# terminal marker stored in a trie node when a keyword ends there
+_KEYWORD = None
+
+_lock = threading.Lock()
+_index = None
+_index_version = None
+
+
+class KeywordIndex:
+    """
+    Prefix tree of all keywords.
+
+    Lookups walk the cleaned sms one character at a time, so matching costs
+    O(len(sms)) and does not touch the database.
+    """
+
+    def __init__(self, keywords):
+        self._root = {}
+        for keyword in keywords:
+            node = self._root
+            for char in str(keyword):
+                node = node.setdefault(char, {})
+            node[_KEYWORD] = keyword
+
+    def match(self, cleaned_sms):
+        """
+        Return the keyword that prefixes `cleaned_sms`, or None.
+
+        If more than one keyword is a prefix, the shortest one wins, as it
+        sorts first.
+        """
+        node = self._root
+        for char in cleaned_sms:
+            try:
+                node = node[char]
+            except KeyError:
+                return None
+            if _KEYWORD in node:
+                return node[_KEYWORD]
+        return None
+
+
+def _current_version():
+    """Read the shared version, initialising it if it has been evicted."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # seed with a timestamp so a re-initialised counter cannot collide
+        # with a version an old process still holds
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def invalidate():
+    """Mark every process's keyword index as stale."""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # key missing, next read will seed it
+        pass
+
+
+def get_index():
+    """Return this process's keyword index, rebuilding it if stale."""
+    global _index, _index_version
+    # read the version before building so a concurrent change forces
+    # another rebuild on the next lookup
+    version = _current_version()
+    if _index is not None and _index_version == version:
+        return _index
+
+    with _lock:
+        if _index is None or _index_version != version:
+            from apostello.models import Keyword
+            _index = KeywordIndex(Keyword.objects.all())
+            _index_version = version
+        return _index
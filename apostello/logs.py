@@ -1,23 +1,57 @@
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import chain, islice
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django_q.models import Schedule
+from django_q.tasks import async
 from twilio.base.exceptions import TwilioRestException
 
 from site_config.models import SiteConfiguration
 
-from .models import Keyword, Recipient, SmsInbound, SmsOutbound
+from . import number_pool
+from .models import Keyword, LogSyncCursor, Recipient, SmsInbound, SmsOutbound
 from .twilio import get_twilio_client
 
 logger = logging.getLogger('apostello')
 
+# wait this long after an sms arrives before checking the outgoing log, this
+# gives Twilio time to log our reply
+OUTGOING_LOG_CHECK_DELAY = timedelta(minutes=1)
+# but never push a pending check back by more than this
+OUTGOING_LOG_CHECK_MAX_DELAY = timedelta(minutes=10)
+OUTGOING_LOG_CHECK_FUNC = 'apostello.tasks.check_outgoing_log'
+OUTGOING_LOG_CHECK_DEADLINE_KEY = 'outgoing_log_check_deadline'
+# re-request a little before the sync cursor to catch messages Twilio logs late
+LOG_SYNC_OVERLAP = timedelta(hours=1)
+# number of messages written to the db at a time when importing logs
+IMPORT_BATCH_SIZE = 500
+# when syncing from a date, split the range into windows of this many days
+# and fetch them concurrently
+LOG_FETCH_WINDOW_DAYS = 7
+LOG_FETCH_WORKERS = 4
+# pages fetched but not yet imported, bounds memory use during a sync
+LOG_FETCH_QUEUE_SIZE = 8
+
 
 def has_expired(dt_):
-    d = get_expiry_date()
-    if d is None:
+    return is_expired(dt_, get_expiry_date())
+
+
+def is_expired(dt_, expiry_date):
+    """Check a date against an expiry date from `get_expiry_date`."""
+    if expiry_date is None:
         return False
-    else:
-        return dt_.date() < d
+    return dt_.date() < expiry_date
 
 
 def get_expiry_date():
@@ -46,34 +80,79 @@ def get_expiry_date():
     return delete_date
 
 
+def expiry_cutoff(expiry_date):
+    """Start of the expiry date, anything before this has expired."""
+    return timezone.make_aware(datetime.combine(expiry_date, datetime.min.time()))
+
+
+def delete_before(model, date_field, cutoff):
+    """
+    Delete rows older than `cutoff` in batches.
+
+    Each batch is a short delete over a range of primary keys, so locks are
+    held briefly and rows are never all loaded at once. We pause between
+    batches to give other queries a chance at the table.
+    """
+    expired = model.objects.filter(**{date_field + '__lt': cutoff})
+    batch_size = settings.SMS_CLEANUP_BATCH_SIZE
+    num_deleted = 0
+    last_pk = 0
+    started = time.monotonic()
+    while True:
+        pks = list(expired.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        num_deleted += expired.filter(pk__gte=pks[0], pk__lte=last_pk).delete()[0]
+        if len(pks) < batch_size:
+            break
+        time.sleep(settings.SMS_CLEANUP_PAUSE)
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        'Deleted %s expired %s in %.1fs (%.0f rows/s)',
+        num_deleted,
+        model._meta.verbose_name_plural,
+        elapsed,
+        num_deleted / elapsed if elapsed else 0,
+    )
+    return num_deleted
+
+
 def cleanup_expired_sms():
     """Remove expired messages."""
     d = get_expiry_date()
-    if d is not None:
-        SmsInbound.objects.filter(time_received__date__lt=d).delete()
-        SmsOutbound.objects.filter(time_sent__date__lt=d).delete()
+    if d is None:
+        return 0
+    cutoff = expiry_cutoff(d)
+    return delete_before(SmsInbound, 'time_received', cutoff) + delete_before(SmsOutbound, 'time_sent', cutoff)
 
 
 def handle_incoming_sms(msg):
     """Add incoming sms to log."""
     if has_expired(msg.date_created):
         return
-    sms, created = SmsInbound.objects.get_or_create(sid=msg.sid)
-    if created:
-        sender, s_created = Recipient.objects.get_or_create(number=msg.from_)
-        if s_created:
-            sender.first_name = 'Unknown'
-            sender.last_name = 'Person'
-            sender.save()
-
-        sms.content = msg.body
-        sms.time_received = msg.date_created
-        sms.sender_name = str(sender)
-        sms.sender_num = msg.from_
-        matched_keyword = Keyword.match(msg.body)
-        sms.matched_keyword = str(matched_keyword)
-        sms.matched_colour = Keyword.lookup_colour(msg.body)
-        sms.save()
+    if SmsInbound.objects.filter(sid=msg.sid).exists():
+        return
+    sender, s_created = Recipient.objects.get_or_create(number=msg.from_)
+    if s_created:
+        sender.first_name = 'Unknown'
+        sender.last_name = 'Person'
+        sender.save()
+
+    classified = Keyword.classify(msg.body)
+    # created with every field set, so the sender's last message is updated
+    SmsInbound.objects.get_or_create(
+        sid=msg.sid,
+        defaults={
+            'content': msg.body,
+            'time_received': msg.date_created,
+            'sender_name': str(sender),
+            'sender_num': msg.from_,
+            'matched_keyword': classified.keyword_name,
+            'matched_colour': classified.colour,
+        },
+    )
 
 
 def handle_outgoing_sms(msg):
@@ -99,35 +178,377 @@ def handle_outgoing_sms(msg):
         logger.error('Could not import sms.', exc_info=True, extra={'msg': msg})
 
 
-def fetch_generator(direction):
-    """Fetch generator from twilio."""
-    twilio_num = str(SiteConfiguration.get_solo().twilio_from_num)
+def get_or_create_recipients(numbers):
+    """
+    Map numbers to contacts, creating any we do not know yet.
+
+    Unknown numbers are created in bulk and added to the site's
+    auto-populate groups, like contacts created one at a time.
+    """
+    # compare numbers the way they are stored, not as Twilio formats them
+    as_stored = Recipient._meta.get_field('number').get_prep_value
+    numbers = {n: as_stored(n) for n in numbers}
+    contacts = {as_stored(r.number): r for r in Recipient.objects.filter(number__in=numbers.values())}
+    missing = {stored for stored in numbers.values() if stored not in contacts}
+    if missing:
+        Recipient.objects.bulk_create(
+            [Recipient(number=n, first_name='Unknown', last_name='Person') for n in missing]
+        )
+        # bulk_create does not set pks on every backend, fetch them again
+        created = list(Recipient.objects.filter(number__in=missing))
+        for grp in SiteConfiguration.get_solo().auto_add_new_groups.all():
+            grp.recipient_set.add(*created)
+        contacts.update({as_stored(r.number): r for r in created})
+    return {n: contacts[stored] for n, stored in numbers.items()}
+
+
+def import_incoming_page(msgs, expiry_date=None):
+    """
+    Add a page of incoming sms to the log.
+
+    Messages from before `expiry_date` are skipped. The caller looks the
+    date up once per sync, rather than once per message.
+
+    Uses a fixed number of queries per page rather than several per message.
+    Falls back to one message at a time if a message is written by someone
+    else while we import.
+    """
+    msgs = [m for m in msgs if not is_expired(m.date_created, expiry_date)]
+    existing = set(SmsInbound.objects.filter(sid__in=[m.sid for m in msgs]).values_list('sid', flat=True))
+    new_msgs = {m.sid: m for m in msgs if m.sid not in existing}.values()
+    if not new_msgs:
+        return 0
+
+    try:
+        with transaction.atomic():
+            senders = get_or_create_recipients(m.from_ for m in new_msgs)
+            smss = []
+            for msg in new_msgs:
+                classified = Keyword.classify(msg.body)
+                smss.append(
+                    SmsInbound(
+                        sid=msg.sid,
+                        content=msg.body,
+                        time_received=msg.date_created,
+                        sender_name=str(senders[msg.from_]),
+                        sender_num=msg.from_,
+                        matched_keyword=classified.keyword_name,
+                        matched_colour=classified.colour,
+                    )
+                )
+            SmsInbound.objects.bulk_create(smss)
+            # bulk_create skips SmsInbound.save
+            Recipient.update_last_inbound(r.number for r in senders.values())
+    except IntegrityError:
+        logger.info('Bulk import collided, importing page one sms at a time')
+        for msg in new_msgs:
+            handle_incoming_sms(msg)
+
+    # update number of matched responses caches, once per page
+    async('apostello.tasks.populate_keyword_response_count')
+    return len(new_msgs)
+
+
+def import_outgoing_page(msgs, expiry_date=None):
+    """Add a page of outgoing sms to the log, see `import_incoming_page`."""
+    msgs = [m for m in msgs if not is_expired(m.date_sent or m.date_created, expiry_date)]
+    existing = set(SmsOutbound.objects.filter(sid__in=[m.sid for m in msgs]).values_list('sid', flat=True))
+    new_msgs = {m.sid: m for m in msgs if m.sid not in existing}.values()
+    if not new_msgs:
+        return 0
+
+    try:
+        with transaction.atomic():
+            recipients = get_or_create_recipients(m.to for m in new_msgs)
+            SmsOutbound.objects.bulk_create(
+                [
+                    SmsOutbound(
+                        sid=msg.sid,
+                        content=msg.body,
+                        # messages still queued at Twilio have no sent date yet
+                        time_sent=msg.date_sent or msg.date_created,
+                        sent_by="[Imported]",
+                        recipient=recipients[msg.to],
+                        status=msg.status,
+                    ) for msg in new_msgs
+                ]
+            )
+    except IntegrityError:
+        logger.info('Bulk import collided, importing page one sms at a time')
+        for msg in new_msgs:
+            handle_outgoing_sms(msg)
+
+    return len(new_msgs)
+
+
+def _log_filters(direction):
+    """
+    Filter arguments selecting messages in one direction.
+
+    Twilio filters on a single number, so there is one set of filters for
+    each of our numbers.
+    """
+    if direction == 'in':
+        field = 'to'
+    elif direction == 'out':
+        field = 'from_'
+    else:
+        return None
+    return [{field: number} for number in number_pool.our_numbers()]
+
+
+def _as_utc_date(since):
+    if isinstance(since, datetime):
+        return since.astimezone(timezone.utc).date()
+    return since
+
+
+def fetch_generator(direction, since=None):
+    """
+    Fetch generator from twilio.
+
+    If `since` is given, only messages sent on or after that day are
+    requested (Twilio's date filters work on whole days).
+    """
+    filters = _log_filters(direction)
+    if filters is None:
+        return []
+    if since is not None:
+        for number_filters in filters:
+            number_filters['date_sent_after'] = _as_utc_date(since)
+    client = get_twilio_client()
+    if len(filters) == 1:
+        return client.messages.stream(**filters[0])
+    return chain.from_iterable(client.messages.stream(**f) for f in filters)
+
+
+def batches(iterable, size):
+    """Split an iterable into lists of at most `size` items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def fetch_windows(since, until):
+    """
+    Split the days from `since` to `until` into fetch windows.
+
+    Both ends of a window are inclusive, as they are in Twilio's date
+    filters, so consecutive windows do not overlap.
+    """
+    step = timedelta(days=LOG_FETCH_WINDOW_DAYS)
+    windows = []
+    start = since
+    while True:
+        end = start + step - timedelta(days=1)
+        if end >= until:
+            windows.append((start, None))
+            return windows
+        windows.append((start, end))
+        start = end + timedelta(days=1)
+
+
+# marks the end of a window's pages in the fetch queue
+_WINDOW_DONE = object()
+
+
+def fetch_pages(direction, since=None):
+    """
+    Fetch pages of messages from Twilio.
+
+    Without `since` the whole log is walked on this thread. With it, the
+    range is split into date windows that are fetched concurrently, for
+    each of our numbers. Pages
+    are handed back through a bounded queue, so a slow importer holds up
+    the fetchers rather than letting pages pile up in memory. Pages from
+    different windows arrive in no particular order.
+    """
+    filters = _log_filters(direction)
+    if filters is None:
+        return
+    if since is None:
+        yield from batches(fetch_generator(direction), IMPORT_BATCH_SIZE)
+        return
+
+    client = get_twilio_client()
+    windows = fetch_windows(_as_utc_date(since), timezone.now().astimezone(timezone.utc).date())
+    pages = queue.Queue(maxsize=LOG_FETCH_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer has gone away, rather than block forever
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_window(number_filters, window):
+        after, before = window
+        try:
+            if stop.is_set():
+                return
+            window_filters = dict(number_filters, date_sent_after=after)
+            if before is not None:
+                window_filters['date_sent_before'] = before
+            for page in batches(client.messages.stream(**window_filters), IMPORT_BATCH_SIZE):
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(_WINDOW_DONE)
+
+    executor = ThreadPoolExecutor(max_workers=LOG_FETCH_WORKERS)
+    try:
+        for number_filters in filters:
+            for window in windows:
+                executor.submit(fetch_window, number_filters, window)
+        remaining = len(filters) * len(windows)
+        while remaining:
+            item = pages.get()
+            if item is _WINDOW_DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def message_date(msg, direction):
+    """Date used to track sync progress for a message."""
     if direction == 'in':
-        return get_twilio_client().messages.list(to=twilio_num)
-    if direction == 'out':
-        return get_twilio_client().messages.list(from_=twilio_num)
-    return []
+        return msg.date_created
+    return msg.date_sent
 
 
-def check_log(direction):
-    """Abstract check log function."""
+def since_date(value):
+    """Parse the --since argument of the log import commands."""
+    d = parse_date(value)
+    if d is None:
+        raise CommandError('--since must be a date in the format YYYY-MM-DD')
+    return d
+
+
+def check_log(direction, full=False, since=None):
+    """
+    Abstract check log function.
+
+    By default only messages newer than the stored sync cursor are fetched.
+    Pass `full=True` to walk the whole log, or `since` to start from a
+    given date.
+    """
     if direction == 'in':
-        sms_handler = handle_incoming_sms
+        page_importer = import_incoming_page
     elif direction == 'out':
-        sms_handler = handle_outgoing_sms
+        page_importer = import_outgoing_page
+
+    cursor, _ = LogSyncCursor.objects.get_or_create(direction=direction)
+    if since is None and not full and cursor.last_date is not None:
+        since = cursor.last_date - LOG_SYNC_OVERLAP
+    expiry_date = get_expiry_date()
+    if expiry_date is not None:
+        # don't fetch messages we would only throw away
+        since = expiry_date if since is None else max(_as_utc_date(since), expiry_date)
 
-    # we want to iterate over all the incoming messages
-    sms_page = fetch_generator(direction)
+    newest_date, newest_sid = cursor.last_date, cursor.last_sid
+    for page in fetch_pages(direction, since=since):
+        page_importer(page, expiry_date=expiry_date)
+        for msg in page:
+            msg_date = message_date(msg, direction)
+            if msg_date is not None and (newest_date is None or msg_date > newest_date):
+                newest_date, newest_sid = msg_date, msg.sid
 
-    for msg in sms_page:
-        sms_handler(msg)
+    # only move the cursor once the whole range has been imported
+    cursor.last_date = newest_date
+    cursor.last_sid = newest_sid
+    cursor.last_synced = timezone.now()
+    cursor.save()
 
 
-def check_incoming_log():
+def check_incoming_log(full=False, since=None):
     """Check Twilio's logs for messages that have been sent to our number."""
-    check_log('in')
+    check_log('in', full=full, since=since)
+
+
+def check_incoming_sms(sid):
+    """
+    Check a single incoming message against Twilio's log.
+
+    Only fetches the message we have just processed, so the cost does not
+    grow with the size of the log. The full sweep is left to a daily task.
+    """
+    try:
+        msg = get_twilio_client().messages(sid).fetch()
+    except TwilioRestException:
+        logger.warning('Could not fetch sms %s from Twilio', sid, exc_info=True)
+        return
+    handle_incoming_sms(msg)
 
 
-def check_outgoing_log():
+def check_outgoing_log(full=False, since=None):
     """Check Twilio's logs for messages that we have sent."""
-    check_log('out')
+    check_log('out', full=full, since=since)
+
+
+def pending_outgoing_log_checks():
+    """Outgoing log checks that are scheduled, but have not run yet."""
+    return Schedule.objects.filter(
+        func=OUTGOING_LOG_CHECK_FUNC,
+        schedule_type=Schedule.ONCE,
+    ).exclude(repeats=0).order_by('next_run')
+
+
+def next_outgoing_log_check():
+    """Time of the next outgoing log check, if there is one."""
+    check = pending_outgoing_log_checks().first()
+    if check is None:
+        return None
+    return check.next_run
+
+
+def schedule_outgoing_log_check():
+    """
+    Debounced request to check the outgoing log.
+
+    There is at most one pending check. Each new request pushes it back to
+    a minute from now, so a burst of messages is reconciled in a single pass,
+    but a check is never delayed more than ten minutes past the first request.
+    """
+    now = timezone.now()
+    next_run = now + OUTGOING_LOG_CHECK_DELAY
+    with transaction.atomic():
+        pending = list(pending_outgoing_log_checks().select_for_update())
+        if not pending:
+            Schedule.objects.create(
+                func=OUTGOING_LOG_CHECK_FUNC,
+                schedule_type=Schedule.ONCE,
+                repeats=-1,
+                next_run=next_run,
+            )
+            cache.set(
+                OUTGOING_LOG_CHECK_DEADLINE_KEY,
+                now + OUTGOING_LOG_CHECK_MAX_DELAY,
+                OUTGOING_LOG_CHECK_MAX_DELAY.total_seconds(),
+            )
+            return next_run
+
+        check = pending[0]
+        for duplicate in pending[1:]:
+            # merge any checks created by concurrent requests
+            duplicate.delete()
+        deadline = cache.get(OUTGOING_LOG_CHECK_DEADLINE_KEY) or check.next_run
+        extended = max(check.next_run, min(next_run, deadline))
+        if extended != check.next_run:
+            check.next_run = extended
+            check.save()
+
+    return check.next_run
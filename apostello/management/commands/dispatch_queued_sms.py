@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from apostello import dispatcher
+
+
+class Command(BaseCommand):
+    """Send queued messages as soon as they are due."""
+    help = 'Send scheduled messages on time, run alongside the django-q cluster.'
+
+    def handle(self, *args, **options):
+        """Handle the command."""
+        dispatcher.run()
@@ -1,17 +1,36 @@
 # -*- coding: utf-8 -*-
 from django.core.management.base import BaseCommand
 
-from apostello.logs import check_outgoing_log
+from apostello.logs import check_outgoing_log, since_date
 
 
 class Command(BaseCommand):
     """
     Checks Twilio's outgoing logs for our number and updates the
     database to match.
+
+    Only messages since the last sync are fetched, unless --full or --since
+    is used.
     """
     args = ''
     help = 'Import outgoing messages from twilio'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='Import the whole log, ignoring the last sync.',
+        )
+        parser.add_argument(
+            '--since',
+            type=since_date,
+            dest='since',
+            default=None,
+            help='Import messages sent on or after this date (YYYY-MM-DD).',
+        )
+
     def handle(self, *args, **options):
         """Handle the command."""
-        check_outgoing_log()
+        check_outgoing_log(full=options['full'], since=options['since'])
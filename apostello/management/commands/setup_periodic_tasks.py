@@ -26,6 +26,7 @@ class Command(BaseCommand):
         next_3am = add_day_if_req(now.replace(hour=3))
         next_230am = add_day_if_req(now.replace(hour=2, minute=30))
         next_2130 = add_day_if_req(now.replace(hour=21, minute=30))
+        next_4am = add_day_if_req(now.replace(hour=4))
         if Schedule.objects.filter(func='apostello.tasks.send_queued_sms').count() < 1:
             Schedule.objects.create(
                 func='apostello.tasks.send_queued_sms',
@@ -33,6 +34,20 @@ class Command(BaseCommand):
                 minutes=1,
             )
 
+        if Schedule.objects.filter(func='apostello.tasks.resume_send_jobs').count() < 1:
+            Schedule.objects.create(
+                func='apostello.tasks.resume_send_jobs',
+                schedule_type=Schedule.MINUTES,
+                minutes=5,
+            )
+
+        if Schedule.objects.filter(func='apostello.tasks.sweep_sms_status_updates').count() < 1:
+            Schedule.objects.create(
+                func='apostello.tasks.sweep_sms_status_updates',
+                schedule_type=Schedule.MINUTES,
+                minutes=5,
+            )
+
         if Schedule.objects.filter(func='apostello.tasks.pull_elvanto_groups').count() < 1:
             Schedule.objects.create(
                 func='apostello.tasks.pull_elvanto_groups',
@@ -72,3 +87,11 @@ class Command(BaseCommand):
                 repeats=-1,
                 next_run=next_3am,
             )
+
+        if Schedule.objects.filter(func='apostello.tasks.check_incoming_log').count() < 1:
+            Schedule.objects.create(
+                func='apostello.tasks.check_incoming_log',
+                schedule_type=Schedule.DAILY,
+                repeats=-1,
+                next_run=next_4am,
+            )
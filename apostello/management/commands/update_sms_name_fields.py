@@ -1,16 +1,82 @@
 # -*- coding: utf-8 -*-
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Case, CharField, Value, When
 
-from apostello.models import Recipient
-from apostello.tasks import update_msgs_name
+from apostello.models import Recipient, SmsInbound
+
+# contacts per CASE update, each binds three parameters and SQLite allows
+# no more than 999 in one statement
+CASE_BATCH_SIZE = 300
+
+
+def update_names_postgres(first_id, last_id):
+    """Update names for a range of contacts with a single joined update."""
+    sql = '''
+        UPDATE {sms} AS s
+        SET sender_name = r.first_name || ' ' || r.last_name
+        FROM {recipient} AS r
+        WHERE s.sender_num = r.number
+            AND r.id BETWEEN %s AND %s
+            AND s.sender_name IS DISTINCT FROM r.first_name || ' ' || r.last_name
+    '''.format(
+        sms=connection.ops.quote_name(SmsInbound._meta.db_table),
+        recipient=connection.ops.quote_name(Recipient._meta.db_table),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [first_id, last_id])
+        return cursor.rowcount
+
+
+def update_names_case(first_id, last_id):
+    """Update names for a range of contacts with a CASE update per CASE_BATCH_SIZE contacts."""
+    contacts = Recipient.objects.filter(id__gte=first_id, id__lte=last_id)
+    names = [(str(c.number), str(c)) for c in contacts.only('first_name', 'last_name', 'number')]
+    num_updated = 0
+    for start in range(0, len(names), CASE_BATCH_SIZE):
+        batch = names[start:start + CASE_BATCH_SIZE]
+        num_updated += SmsInbound.objects.filter(sender_num__in=[num for num, _ in batch]).update(
+            sender_name=Case(
+                *[When(sender_num=num, then=Value(name)) for num, name in batch],
+                output_field=CharField(),
+            )
+        )
+    return num_updated
 
 
 class Command(BaseCommand):
-    """Updates names on messages for all existing contacts."""
+    """
+    Updates names on messages for all existing contacts.
+
+    Contacts are processed in batches of ids, each batch is one UPDATE
+    statement on Postgres, and one per CASE_BATCH_SIZE contacts elsewhere.
+    """
     args = ''
     help = 'Update from_name fields'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=1000,
+            help='Number of contacts to update per query.',
+        )
+
     def handle(self, *args, **options):
         """Handle the command."""
-        for c in Recipient.objects.all():
-            update_msgs_name(c.id)
+        batch_size = options['batch_size']
+        if connection.vendor == 'postgresql':
+            update_names = update_names_postgres
+        else:
+            update_names = update_names_case
+
+        ids = list(Recipient.objects.order_by('id').values_list('id', flat=True))
+        num_msgs = 0
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            with transaction.atomic():
+                num_msgs += update_names(batch[0], batch[-1])
+            self.stdout.write(
+                'Updated {0}/{1} contacts, {2} messages changed'.format(start + len(batch), len(ids), num_msgs)
+            )
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.3 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apostello', '0023_smsoutbound_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogSyncCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('direction', models.CharField(choices=[('in', 'Incoming'), ('out', 'Outgoing')], max_length=3, unique=True)),
+                ('last_date', models.DateTimeField(blank=True, help_text='Date of the newest message seen.', null=True)),
+                ('last_sid', models.CharField(blank=True, help_text='SID of the newest message seen.', max_length=34)),
+                ('last_synced', models.DateTimeField(blank=True, help_text='Time of the last completed sync.', null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.0.3 on 2026-10-18 11:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apostello', '0024_logsynccursor'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='smsinbound',
+            name='time_received',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='smsoutbound',
+            name='time_sent',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
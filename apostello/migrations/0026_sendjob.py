@@ -0,0 +1,38 @@
+# Generated by Django 2.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apostello', '0025_sms_time_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.CharField(max_length=1600, verbose_name='Message')),
+                ('sent_by', models.CharField(max_length=200, verbose_name='Sender')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('complete', 'Complete')], db_index=True, default='queued', max_length=10)),
+                ('total', models.PositiveIntegerField(default=0, help_text='Number of recipients when the job was created.')),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('checkpoint', models.PositiveIntegerField(default=0, help_text='Pk of the last recipient handled.')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('recipient_group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='apostello.RecipientGroup')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.AddField(
+            model_name='smsoutbound',
+            name='send_job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='apostello.SendJob'),
+        ),
+    ]
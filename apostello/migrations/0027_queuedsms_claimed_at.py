@@ -0,0 +1,18 @@
+# Generated by Django 2.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apostello', '0026_sendjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedsms',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apostello', '0027_queuedsms_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='queuedsms',
+            index=models.Index(fields=['sent', 'time_to_send'], name='queuedsms_due_idx'),
+        ),
+    ]
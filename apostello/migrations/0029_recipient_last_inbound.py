@@ -0,0 +1,30 @@
+# Generated by Django 2.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+import django.db.models.deletion
+
+
+def set_last_inbound(apps, schema_editor):
+    Recipient = apps.get_model('apostello', 'Recipient')
+    SmsInbound = apps.get_model('apostello', 'SmsInbound')
+    latest = SmsInbound.objects.filter(sender_num=OuterRef('number')).order_by(
+        F('time_received').desc(nulls_last=True), '-pk'
+    )
+    Recipient.objects.update(last_inbound=Subquery(latest.values('pk')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apostello', '0028_queuedsms_due_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipient',
+            name='last_inbound',
+            field=models.ForeignKey(blank=True, editable=False, help_text='Most recent message from this person.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='apostello.SmsInbound'),
+        ),
+        migrations.RunPython(set_last_inbound, migrations.RunPython.noop, elidable=True),
+    ]
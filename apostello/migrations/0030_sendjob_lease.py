@@ -0,0 +1,37 @@
+# Generated by Django 2.0.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apostello', '0029_recipient_last_inbound'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sendjob',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sendjob',
+            name='lease_owner',
+            field=models.CharField(blank=True, help_text='Token of the task allowed to send.', max_length=32),
+        ),
+        migrations.CreateModel(
+            name='SendJobRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('claimed', 'Claimed'), ('sent', 'Sent'), ('failed', 'Failed')], default='claimed', max_length=10)),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='apostello.Recipient')),
+                ('send_job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='apostello.SendJob')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='sendjobrecipient',
+            unique_together={('send_job', 'recipient')},
+        ),
+    ]
@@ -1,7 +1,6 @@
 import hashlib
 import logging
 import re
-from math import ceil
 
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -9,13 +8,15 @@ from django.core.cache import cache
 from django.core.cache.utils import make_template_fragment_key
 from django.core.exceptions import ValidationError
 from django.urls import reverse
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Q, Subquery
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django_q.models import Schedule
 from django_q.tasks import async, schedule
 from phonenumber_field.modelfields import PhoneNumberField
 
+from apostello import keyword_index, segments
 from apostello.exceptions import NoKeywordMatchException
 from apostello.utils import fetch_default_reply
 from apostello.validators import (
@@ -56,12 +57,18 @@ class RecipientGroup(models.Model):
 
     def check_user_cost_limit(self, limit, msg):
         """Check the user has not exceeded their per SMS cost limit."""
-        num_sms = ceil(len(msg) / 160)
         if limit == 0:
             return
-        if limit < num_sms * self.calculate_cost():
+        if limit < self.message_cost(msg):
             raise ValidationError('Sorry, you can only send messages that cost no more than ${0}.'.format(limit))
 
+    def message_cost(self, msg):
+        """Cost of sending `msg` to everyone in the group we can send to."""
+        try:
+            return Recipient.message_cost(self.recipient_set.filter(is_archived=False, is_blocking=False), msg)
+        except ConfigurationError:
+            return 0
+
     @cached_property
     def all_recipients(self):
         """Returns queryset of all recipients in group."""
@@ -129,6 +136,31 @@ class Recipient(models.Model):
         null=True,
     )
     groups = models.ManyToManyField(RecipientGroup, blank=True)
+    last_inbound = models.ForeignKey(
+        'SmsInbound',
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='+',
+        on_delete=models.SET_NULL,
+        help_text='Most recent message from this person.',
+    )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the name and number as loaded, so we can tell if they change."""
+        instance = super(Recipient, cls).from_db(db, field_names, values)
+        loaded = dict(zip(field_names, values))
+        if all(f in loaded for f in ('first_name', 'last_name', 'number')):
+            instance._saved_sender = (loaded['first_name'], loaded['last_name'], str(loaded['number']))
+        return instance
+
+    def _sender_details(self):
+        return (self.first_name, self.last_name, str(self.number))
+
+    def sender_changed(self):
+        """Has the name or number changed since the recipient was loaded or saved?"""
+        return getattr(self, '_saved_sender', None) != self._sender_details()
 
     def personalise(self, message):
         """
@@ -175,13 +207,22 @@ class Recipient(models.Model):
     @staticmethod
     def check_user_cost_limit(recipients, limit, msg):
         """Check the user has not exceeded their per SMS cost limit."""
-        cost = SiteConfiguration.get_twilio_settings()['sending_cost']
-        num_sms = ceil(len(msg) / 160)
         if limit == 0:
             return
-        if limit < len(recipients) * cost * num_sms:
+        if limit < Recipient.message_cost(recipients, msg):
             raise ValidationError('Sorry, you can only send messages that cost no more than ${0}.'.format(limit))
 
+    @staticmethod
+    def message_cost(recipients, msg):
+        """
+        Cost of sending `msg` to `recipients`, personalised for each.
+
+        `recipients` can be a queryset, counted with a single query, or a
+        list of recipients.
+        """
+        cost = SiteConfiguration.get_twilio_settings()['sending_cost']
+        return cost * segments.total_segments(msg, segments.first_name_counts(recipients))
+
     @cached_property
     def full_name(self):
         """Recipient's full name."""
@@ -189,26 +230,42 @@ class Recipient(models.Model):
 
     @property
     def last_sms(self):
-        """Last message sent to this person"""
-        last_sms = cache.get('last_msg__{0}'.format(self.pk))
-        if last_sms is None:
-            msg = SmsInbound.objects.filter(sender_num=str(self.number))
-            try:
-                msg = msg[0]  # sms are already sorted in time
-                t = msg.time_received
-                if t is not None:
-                    t = t.strftime('%d %b %H:%M')
-                last_sms = {'content': msg.content, 'time_received': t}
-            except IndexError:
-                last_sms = {'content': '', 'time_received': ''}
-            cache.set('last_msg__{0}'.format(self.pk), last_sms, 600)
-        return last_sms
+        """Last message sent by this person."""
+        msg = self.last_inbound
+        if msg is None:
+            return {'content': '', 'time_received': ''}
+        t = msg.time_received
+        if t is not None:
+            t = t.strftime('%d %b %H:%M')
+        return {'content': msg.content, 'time_received': t}
+
+    @staticmethod
+    def update_last_inbound(numbers=None):
+        """
+        Point contacts at their most recent message.
+
+        Used after messages are written without `SmsInbound.save`. Pass
+        `numbers` to only update those contacts.
+        """
+        latest = SmsInbound.objects.filter(sender_num=OuterRef('number')).order_by(
+            F('time_received').desc(nulls_last=True), '-pk'
+        )
+        contacts = Recipient.objects.all()
+        if numbers is not None:
+            contacts = contacts.filter(number__in=[str(n) for n in numbers])
+        return contacts.update(last_inbound=Subquery(latest.values('pk')[:1]))
 
     def save(self, *args, **kwargs):
-        """Override save method to back date name change to SMS."""
+        """Override save method to back date name or number change to SMS."""
         add_to_group_flag = self.pk is None
+        sender_changed = self.sender_changed()
         super(Recipient, self).save(*args, **kwargs)
-        async('apostello.tasks.update_msgs_name', self.pk)
+        if sender_changed:
+            self._saved_sender = self._sender_details()
+            self.__dict__.pop('full_name', None)
+            async('apostello.tasks.update_msgs_name', self.pk)
+            # we may already have messages from a new contact or number
+            Recipient.update_last_inbound([self.number])
         if add_to_group_flag:
             from apostello.tasks import add_new_contact_to_groups
             async('apostello.tasks.add_new_contact_to_groups', self.pk)
@@ -451,11 +508,18 @@ class Keyword(models.Model):
             raise ValidationError("The start time must be before the end time!")
 
     def save(self, force_insert=False, force_update=False, *args, **kwargs):
-        """Force lower case keywords."""
+        """Force lower case keywords and invalidate the keyword index."""
         self.keyword = self.keyword.lower()
         super(Keyword, self).save(force_insert, force_update, *args, **kwargs)
+        keyword_index.invalidate()
         async('apostello.tasks.populate_keyword_response_count', pk=self.pk)
 
+    def delete(self, *args, **kwargs):
+        """Override delete method to invalidate the keyword index."""
+        result = super(Keyword, self).delete(*args, **kwargs)
+        keyword_index.invalidate()
+        return result
+
     @staticmethod
     def _match(sms):
         """Match keyword or raises exception."""
@@ -472,13 +536,11 @@ class Keyword(models.Model):
         elif cleaned_sms.startswith('name'):
             return 'name'
 
-        for keyword in Keyword.objects.all():
-            if cleaned_sms.startswith(str(keyword)):
-                query_keyword = keyword
-                # return <Keyword object>
-                return query_keyword
-        else:
+        # return <Keyword object>
+        query_keyword = keyword_index.get_index().match(cleaned_sms)
+        if query_keyword is None:
             raise NoKeywordMatchException
+        return query_keyword
 
     @staticmethod
     def match(sms):
@@ -489,10 +551,13 @@ class Keyword(models.Model):
             return 'No Match'
 
     @staticmethod
-    def lookup_colour(sms):
-        """Generate. colour for sms table."""
-        keyword = Keyword.match(sms)
+    def classify(sms):
+        """Match keyword and look up colour in a single pass."""
+        return ClassifiedSms(Keyword.match(sms))
 
+    @staticmethod
+    def colour_of(keyword):
+        """Generate colour for sms table from a match result."""
         if keyword == 'stop':
             return "#FFCDD2"
         elif keyword == 'name':
@@ -502,6 +567,11 @@ class Keyword(models.Model):
         else:
             return "#" + hashlib.md5(str(keyword).encode('utf-8')).hexdigest()[:6]
 
+    @staticmethod
+    def lookup_colour(sms):
+        """Generate colour for sms table."""
+        return Keyword.classify(sms).colour
+
     def __str__(self):
         """Pretty representation."""
         return self.keyword
@@ -510,6 +580,34 @@ class Keyword(models.Model):
         ordering = ['keyword']
 
 
+class ClassifiedSms:
+    """
+    Result of matching an sms against the keywords.
+
+    Computed once per message and passed through the inbound pipeline so
+    the keyword scan and colour hash are not repeated.
+    """
+    RESERVED = ('stop', 'start', 'info', 'name')
+
+    def __init__(self, keyword):
+        # <Keyword object>, a reserved word, or 'No Match'
+        self.keyword = keyword
+        if isinstance(keyword, str) and keyword in self.RESERVED:
+            self.reserved = keyword
+        else:
+            self.reserved = None
+        self.colour = Keyword.colour_of(keyword)
+
+    @property
+    def keyword_name(self):
+        """Matched keyword as stored on SmsInbound.matched_keyword."""
+        return str(self.keyword)
+
+    def __str__(self):
+        """Pretty representation."""
+        return self.keyword_name
+
+
 class SmsInbound(models.Model):
     """A SmsInbound is a message that was sent to the twilio number."""
     sid = models.CharField("SID", max_length=34, unique=True, help_text="Twilio's unique ID for this SMS")
@@ -519,7 +617,7 @@ class SmsInbound(models.Model):
         'to mark people as registered for an event.'
     )
     content = models.CharField("Message body", blank=True, max_length=1600)
-    time_received = models.DateTimeField(blank=True, null=True)
+    time_received = models.DateTimeField(blank=True, null=True, db_index=True)
     sender_name = models.CharField("Sent by", max_length=200)
     sender_num = models.CharField("Sent from", max_length=200)
     matched_keyword = models.CharField(max_length=12, db_index=True)
@@ -549,32 +647,48 @@ class SmsInbound(models.Model):
 
         Note that the message will not be replied to.
         """
-        matched_keyword = Keyword.match(self.content.strip())
-        self.matched_keyword = str(matched_keyword)
-        self.matched_colour = Keyword.lookup_colour(self.content.strip())
+        classified = Keyword.classify(self.content.strip())
+        self.matched_keyword = classified.keyword_name
+        self.matched_colour = classified.colour
         self.is_archived = False
         self.dealt_with = False
         self.save()
         return self
 
     def save(self, *args, **kwargs):
-        """Override save method to invalidate cache."""
+        """Override save method to track the sender's last message and invalidate caches."""
+        adding = self._state.adding
         super(SmsInbound, self).save(*args, **kwargs)
-        # invalidate per person last sms cache
-        cache.set('last_msg__{0}'.format(self.sender_num), None, 0)
+        if adding:
+            self.set_as_last_inbound()
         # update number of matched responses caches
         async('apostello.tasks.populate_keyword_response_count')
 
+    def set_as_last_inbound(self):
+        """Make this the sender's last message, unless they have sent a newer one."""
+        older = Q(last_inbound__isnull=True)
+        if self.time_received is not None:
+            older |= Q(last_inbound__time_received__isnull=True)
+            older |= Q(last_inbound__time_received__lte=self.time_received)
+        Recipient.objects.filter(older, number=self.sender_num).update(last_inbound=self)
+
     class Meta:
         ordering = ['-time_received']
         index_together = ['is_archived', 'matched_keyword']
 
 
 class QueuedSms(models.Model):
-    """And outbound SMS to be sent at a later time."""
+    """
+    And outbound SMS to be sent at a later time.
+
+    A message to a group is stored once, with no `recipient`, and the
+    group's members are looked up when it is sent. Due messages are claimed
+    by a worker, by setting `claimed_at`, before they are sent.
+    """
     time_to_send = models.DateTimeField()
     sent = models.BooleanField(default=False)
     failed = models.BooleanField(default=False)
+    claimed_at = models.DateTimeField(null=True, blank=True)
     content = models.CharField(
         "Message",
         max_length=1600,
@@ -591,40 +705,46 @@ class QueuedSms(models.Model):
                                   ,on_delete=models.CASCADE,
                                   )
 
+    def save(self, *args, **kwargs):
+        super(QueuedSms, self).save(*args, **kwargs)
+        if not self.sent:
+            from apostello.dispatcher import wake
+            transaction.on_commit(wake)
+
     def cancel(self):
         """Cancel message."""
         self.delete()
 
+    @property
+    def is_group_send(self):
+        return self.recipient_id is None and self.recipient_group_id is not None
+
+    @cached_property
+    def recipient_count(self):
+        """Number of people this message will go to."""
+        if not self.is_group_send:
+            return 1
+        num_recipients = getattr(self, 'num_recipients', None)
+        if num_recipients is not None:
+            return num_recipients
+        return self.recipient_group.recipient_set.filter(is_archived=False, is_blocking=False).count()
+
     def send(self):
         """Send the sms."""
         if self.sent or self.failed:
             # only try to send once
             return
 
-        from apostello.tasks import recipient_send_message_task
-        try:
-            if self.recipient_group is not None:
-                group = self.recipient_group.name
-            else:
-                group = None
-            recipient_send_message_task(
-                self.recipient.pk,
-                self.content,
-                group,
-                self.sent_by,
-            )
-            self.sent = True
-        except Exception as e:
-            self.failed = True
-
-        self.save()
+        from apostello.sending import send_queued
+        send_queued([self.pk])
+        self.refresh_from_db()
 
     def __str__(self):
         """Pretty representation."""
         status = "Sent" if self.sent else "Queued"
         val = "[{status}] To: {recipient} Msg: {content}\nScheduled for {time}".format(
             status=status,
-            recipient=self.recipient,
+            recipient=self.recipient_group if self.is_group_send else self.recipient,
             content=self.content,
             time=self.time_to_send,
         )
@@ -632,6 +752,81 @@ class QueuedSms(models.Model):
 
     class Meta:
         ordering = ['time_to_send']
+        indexes = [
+            models.Index(fields=['sent', 'time_to_send'], name='queuedsms_due_idx'),
+        ]
+
+
+class SendJob(models.Model):
+    """
+    Tracks a group send.
+
+    Recipients are sent to in order of pk. `checkpoint` is the pk of the
+    last chunk of recipients handled, so an interrupted job resumes after
+    it. Only the task holding the lease may send for the job, and each
+    chunk hands the lease on to the task for the next chunk.
+    """
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    COMPLETE = 'complete'
+    STATUSES = (
+        (QUEUED, 'Queued'),
+        (SENDING, 'Sending'),
+        (COMPLETE, 'Complete'),
+    )
+    content = models.CharField("Message", max_length=1600)
+    sent_by = models.CharField("Sender", max_length=200)
+    recipient_group = models.ForeignKey(RecipientGroup, null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED, db_index=True)
+    total = models.PositiveIntegerField(default=0, help_text='Number of recipients when the job was created.')
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    checkpoint = models.PositiveIntegerField(default=0, help_text='Pk of the last recipient handled.')
+    lease_owner = models.CharField(max_length=32, blank=True, help_text='Token of the task allowed to send.')
+    lease_expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def progress(self):
+        """Fraction of recipients handled so far."""
+        if not self.total:
+            return 1.0
+        return min((self.sent + self.failed) / self.total, 1.0)
+
+    def __str__(self):
+        """Pretty representation."""
+        return f'{self.recipient_group}: {self.sent + self.failed}/{self.total}'
+
+    class Meta:
+        ordering = ['-created']
+
+
+class SendJobRecipient(models.Model):
+    """
+    A recipient of a group send.
+
+    A row is added before the message is sent, so no recipient is sent to
+    twice by the same job, even if a chunk is run again.
+    """
+    CLAIMED = 'claimed'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = (
+        (CLAIMED, 'Claimed'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+    send_job = models.ForeignKey(SendJob, on_delete=models.CASCADE)
+    recipient = models.ForeignKey(Recipient, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUSES, default=CLAIMED)
+
+    def __str__(self):
+        """Pretty representation."""
+        return f'{self.send_job_id}: {self.recipient_id} ({self.status})'
+
+    class Meta:
+        unique_together = ('send_job', 'recipient')
 
 
 class SmsOutbound(models.Model):
@@ -642,7 +837,7 @@ class SmsOutbound(models.Model):
         max_length=1600,
         validators=[gsm_validator],
     )
-    time_sent = models.DateTimeField(default=timezone.now)
+    time_sent = models.DateTimeField(default=timezone.now, db_index=True)
     sent_by = models.CharField(
         "Sender", max_length=200, help_text='User that sent message. Stored for auditing purposes.'
     )
@@ -656,6 +851,7 @@ class SmsOutbound(models.Model):
     status = models.CharField(
         'Status', max_length=50, help_text='Status of SMS (from Twilio)',
     )
+    send_job = models.ForeignKey(SendJob, null=True, blank=True, on_delete=models.SET_NULL)
 
     def __str__(self):
         """Pretty representation."""
@@ -665,6 +861,27 @@ class SmsOutbound(models.Model):
         ordering = ['-time_sent']
 
 
+class LogSyncCursor(models.Model):
+    """
+    Stores how far we have synced with Twilio's logs.
+
+    There is one row per direction, the next sync only asks Twilio for
+    messages sent since `last_date`.
+    """
+    DIRECTIONS = (
+        ('in', 'Incoming'),
+        ('out', 'Outgoing'),
+    )
+    direction = models.CharField(max_length=3, choices=DIRECTIONS, unique=True)
+    last_date = models.DateTimeField(null=True, blank=True, help_text='Date of the newest message seen.')
+    last_sid = models.CharField(max_length=34, blank=True, help_text='SID of the newest message seen.')
+    last_synced = models.DateTimeField(null=True, blank=True, help_text='Time of the last completed sync.')
+
+    def __str__(self):
+        """Pretty representation."""
+        return f'{self.direction}: {self.last_date}'
+
+
 class CloudMessageId(models.Model):
     """Store cloud messaging IDs."""
     url = models.CharField(max_length=1000)
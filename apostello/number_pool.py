@@ -0,0 +1,69 @@
+"""
+Pick which of our Twilio numbers to send from.
+
+Carriers throttle each number separately, so group sends are spread across
+the main Twilio number and any `SendingNumber`s. Each contact is assigned a
+number by rendezvous hashing: the contact always hears from the same
+number, and adding or removing a number only moves the contacts assigned
+to that number.
+
+Automatic replies are the exception: they are returned to Twilio as TwiML,
+so they go out from whichever of our numbers the contact texted. That keeps
+a reply in the same thread as the message it answers, even if the contact
+normally hears from another number.
+"""
+from hashlib import sha1
+
+from django.core.cache import cache
+
+from site_config.models import SendingNumber, SiteConfiguration
+
+
+def _numbers():
+    """Numbers we send from, main number first, and retired numbers."""
+    numbers = cache.get('sending_numbers')
+    if numbers is None:
+        sending = []
+        main = SiteConfiguration.get_solo().twilio_from_num
+        if main:
+            sending.append(str(main))
+        retired = []
+        for number, is_active in SendingNumber.objects.values_list('number', 'is_active'):
+            number = str(number)
+            if number not in sending and number not in retired:
+                (sending if is_active else retired).append(number)
+        numbers = (sending, retired)
+        cache.set('sending_numbers', numbers, 3600)
+    return numbers
+
+
+def sending_numbers():
+    """Numbers we send from, main number first."""
+    return _numbers()[0]
+
+
+def our_numbers():
+    """Every number of ours, including ones we no longer send from."""
+    sending, retired = _numbers()
+    return sending + retired
+
+
+def clear_cache():
+    """Forget the cached numbers, after a `SendingNumber` changes."""
+    cache.delete('sending_numbers')
+
+
+def _score(sender, recipient):
+    return sha1('{0}:{1}'.format(sender, recipient).encode('utf-8')).digest()
+
+
+def number_for(recipient_number, numbers=None):
+    """The number `recipient_number` should be sent messages from."""
+    if numbers is None:
+        numbers = sending_numbers()
+    if len(numbers) == 1:
+        return numbers[0]
+    if not numbers:
+        return str(SiteConfiguration.get_solo().twilio_from_num)
+    recipient_number = str(recipient_number)
+    return max(numbers, key=lambda sender: _score(sender, recipient_number))
@@ -0,0 +1,64 @@
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# Reserve the next send slot for a number.
+#
+# The bucket is stored as the time at which it will next be empty. Up to
+# `burst` messages can go at once, after that slots are handed out every
+# `interval` seconds. Returns how long the caller must wait for its slot,
+# as a string (redis truncates lua numbers to integers).
+RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local empty_at = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now)
+local wait = math.max(empty_at - now - (burst - 1) * interval, 0)
+empty_at = empty_at + interval
+redis.call('SET', KEYS[1], tostring(empty_at), 'PX', math.ceil((empty_at - now) * 1000) + 1000)
+return tostring(wait)
+"""
+
+_script = None
+
+
+def sends_within(seconds, rate=None, burst=None):
+    """How many messages one number may send in `seconds`, None if unlimited."""
+    rate = settings.SMS_SEND_RATE if rate is None else rate
+    burst = settings.SMS_SEND_BURST if burst is None else burst
+    if not rate:
+        return None
+    return max(burst, 1) + int(rate * seconds)
+
+
+class TokenBucket:
+    """
+    Send rate limit for one of our numbers, shared by every worker.
+
+    Callers reserve a slot and sleep until it comes up, rather than
+    sending and waiting to be told off by Twilio.
+    """
+
+    def __init__(self, number, rate=None, burst=None):
+        self.key = 'apostello:send_rate:{0}'.format(number)
+        self.rate = settings.SMS_SEND_RATE if rate is None else rate
+        self.burst = settings.SMS_SEND_BURST if burst is None else burst
+
+    def reserve(self, now=None):
+        """Reserve a slot, returns the number of seconds until it."""
+        global _script
+        if not self.rate:
+            return 0
+        if _script is None:
+            _script = get_redis_connection('default').register_script(RESERVE_SCRIPT)
+        if now is None:
+            now = time.time()
+        wait = _script(keys=[self.key], args=[now, 1 / self.rate, max(self.burst, 1)])
+        return float(wait)
+
+    def wait(self):
+        """Block until we may send the next message."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
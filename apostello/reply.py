@@ -1,11 +1,10 @@
 import logging
-from datetime import timedelta
 
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from django_q.models import Schedule
-from django_q.tasks import async, schedule
+from django_q.tasks import async
 
+from apostello.logs import schedule_outgoing_log_check
 from apostello.models import Keyword, Recipient
 from apostello.utils import fetch_default_reply
 
@@ -33,24 +32,25 @@ class InboundSms:
         """
         Kick off background tasks for each message.
 
-        Starts tasks to:
+        Starts a single pipeline task to:
             * Log the message in the db
             * Post the message to slack
             * Send blacklist warnings if required
             * Ask the contact for their name if we don't have it
-            * Schedules a task to check the outgoing log one minute from now
+            * Notify cloud messaging subscribers
+
+        Also requests a (debounced) check of the outgoing log.
         """
-        async('apostello.tasks.log_msg_in', self.msg_params, timezone.now(), self.contact.pk)
-        async('apostello.tasks.sms_to_slack', self.sms_body, str(self.contact), str(self.keyword))
-        async('apostello.tasks.blacklist_notify', self.contact.pk, self.sms_body, self.keyword)
-        async('apostello.tasks.ask_for_name', self.contact.pk, self.sms_body, self.send_name_sms)
-        async('apostello.tasks.send_cloud_messages')
-        # update outgoing log 1 minute from now:
-        schedule(
-            'apostello.tasks.check_outgoing_log',
-            schedule_type=Schedule.ONCE,
-            next_run=timezone.now() + timedelta(minutes=1)
+        async(
+            'apostello.tasks.process_inbound',
+            self.msg_params,
+            timezone.now(),
+            self.contact.pk,
+            self.classified,
+            self.send_name_sms,
         )
+        # update outgoing log in about a minute:
+        schedule_outgoing_log_check()
 
     def reply_to_start(self):
         """Reply to the "start" keyword."""
@@ -76,9 +76,8 @@ class InboundSms:
             last_name = last_name.split('\n')[0]
             last_name = last_name[0:40]  # truncate last name
             self.contact.last_name = last_name
+            # saving updates old messages with this person's name
             self.contact.save()
-            # update old messages with this person's name
-            async('apostello.tasks.update_msgs_name', self.contact.pk)
             # thank person
             async(
                 'apostello.tasks.notify_office_mail',
@@ -128,8 +127,9 @@ class InboundSms:
         self.msg_params = msg_params
         self.contact_number = msg_params['From']
         self.sms_body = msg_params['Body'].strip()
-        # match keyword:
-        self.keyword = Keyword.match(self.sms_body)
+        # match keyword, once for the whole pipeline:
+        self.classified = Keyword.classify(self.sms_body)
+        self.keyword = self.classified.keyword
         # look up contact and determine if we need to ask for their name:
         self.contact, self.send_name_sms = self.lookup_contact()
         # construct reply sms
@@ -0,0 +1,103 @@
+"""
+Work out how many billable segments a message will be sent as.
+
+A message made only of GSM-7 characters fits 160 characters in one
+segment, or 153 per segment once it has to be split. Anything else is sent
+as UCS-2: 70 characters in one segment, 67 per segment when split.
+"""
+from collections import Counter
+from math import ceil
+
+from django.db.models import Count
+
+GSM_BASIC = set(
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+# these take two characters each, an escape and the character
+GSM_EXTENDED = set('^{}\\[~]|€\f')
+
+GSM_SINGLE = 160
+GSM_CONCAT = 153
+UCS2_SINGLE = 70
+UCS2_CONCAT = 67
+
+NAME_PLACEHOLDER = '%name%'
+
+
+def gsm_length(text):
+    """Length of `text` in GSM-7 characters, or None if it needs UCS-2."""
+    length = 0
+    for char in text:
+        if char in GSM_BASIC:
+            length += 1
+        elif char in GSM_EXTENDED:
+            length += 2
+        else:
+            return None
+    return length
+
+
+def ucs2_length(text):
+    """Length of `text` in UTF-16 code units."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def segments(gsm_len, ucs2_len):
+    """
+    Number of segments for a message.
+
+    Pass the GSM-7 length, or None if the message needs UCS-2, and the
+    UCS-2 length.
+    """
+    if gsm_len is not None:
+        length, single, concat = gsm_len, GSM_SINGLE, GSM_CONCAT
+    else:
+        length, single, concat = ucs2_len, UCS2_SINGLE, UCS2_CONCAT
+    if length <= single:
+        return 1
+    return ceil(length / concat)
+
+
+def count_segments(text):
+    """Number of segments `text` is sent as."""
+    return segments(gsm_length(text), ucs2_length(text))
+
+
+def total_segments(msg, first_names):
+    """
+    Total segments to send `msg` to everyone in `first_names`.
+
+    `first_names` maps each first name to the number of recipients with
+    it. The template is measured once and each distinct name once, rather
+    than personalising the message for every recipient.
+    """
+    num_names = msg.count(NAME_PLACEHOLDER)
+    template = msg.replace(NAME_PLACEHOLDER, '')
+    template_gsm = gsm_length(template)
+    template_ucs2 = ucs2_length(template)
+    if num_names == 0:
+        return segments(template_gsm, template_ucs2) * sum(first_names.values())
+
+    total = 0
+    for name, num_recipients in first_names.items():
+        name_gsm = gsm_length(name)
+        if template_gsm is None or name_gsm is None:
+            gsm_len = None
+        else:
+            gsm_len = template_gsm + num_names * name_gsm
+        ucs2_len = template_ucs2 + num_names * ucs2_length(name)
+        total += segments(gsm_len, ucs2_len) * num_recipients
+    return total
+
+
+def first_name_counts(recipients):
+    """
+    Count recipients by first name.
+
+    Querysets are counted in the database with a single query.
+    """
+    if hasattr(recipients, 'values'):
+        rows = recipients.order_by().values('first_name').annotate(n=Count('pk'))
+        return {row['first_name']: row['n'] for row in rows}
+    return Counter(r.first_name for r in recipients)
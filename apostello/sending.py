@@ -0,0 +1,387 @@
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django_q.tasks import async
+from twilio.base.exceptions import TwilioRestException
+
+from apostello import delivery_status, number_pool
+from apostello.models import QueuedSms, Recipient, RecipientGroup, SendJob, SendJobRecipient, SmsOutbound
+from apostello.rate_limit import TokenBucket, sends_within
+from apostello.twilio import get_twilio_client
+
+logger = logging.getLogger('apostello')
+
+# Twilio error code for a number that has replied "stop" to us
+BLACKLISTED_ERROR_CODE = 21610
+# how many times to try again if Twilio says we are sending too fast
+RATE_LIMITED_RETRIES = 3
+# seconds of the task timeout kept back for Twilio latency and retries
+TASK_TIMEOUT_MARGIN = 60
+# how long a queued chunk task has to start before the job is resumed
+JOB_QUEUED_LEASE = timedelta(minutes=10)
+# how long a running chunk task may go without sending before the job is resumed
+JOB_LEASE = timedelta(minutes=2)
+# a claimed queued sms not sent after this long is claimed again
+STALE_CLAIM_AGE = timedelta(minutes=10)
+
+
+def create_message(client, body, to, from_, bucket=None):
+    """
+    Send a single sms, paced by the send rate limit of our number.
+
+    If Twilio still rejects the message for being sent too quickly, wait
+    and try again.
+    """
+    if bucket is None:
+        bucket = TokenBucket(from_)
+    callback = {}
+    if settings.TWILIO_STATUS_CALLBACK_URL:
+        callback['status_callback'] = settings.TWILIO_STATUS_CALLBACK_URL
+    tries = 0
+    while True:
+        bucket.wait()
+        try:
+            return client.messages.create(body=body, to=to, from_=from_, **callback)
+        except TwilioRestException as e:
+            if e.status != 429 or tries >= RATE_LIMITED_RETRIES:
+                raise
+            tries += 1
+            logger.warning('Twilio rate limited sms to %s, retrying', to)
+            time.sleep(2**tries)
+
+
+def chunk_size():
+    """
+    How many messages one send task should handle.
+
+    Sending is paced by the rate limit, so a chunk is sized to be sent in
+    SMS_SEND_CHUNK_SECONDS, and never near the django-q task timeout.
+    """
+    timeout = settings.Q_CLUSTER.get('timeout', 120)
+    seconds = max(min(settings.SMS_SEND_CHUNK_SECONDS, timeout - TASK_TIMEOUT_MARGIN), 0)
+    per_number = sends_within(seconds)
+    if per_number is None:
+        return settings.SMS_SEND_CHUNK_SIZE
+    return max(1, min(settings.SMS_SEND_CHUNK_SIZE, per_number * max(len(number_pool.sending_numbers()), 1)))
+
+
+def sendable_recipients(group):
+    """Members of a group we can send to."""
+    return Recipient.objects.filter(groups=group, is_archived=False, is_blocking=False)
+
+
+def group_recipients(group, after=0, limit=None):
+    """
+    Load recipients in a group, in pk order, starting after pk `after`.
+
+    Returns plain dicts, so chunks of recipients can be passed around
+    without re-fetching them.
+    """
+    contacts = sendable_recipients(group).filter(pk__gt=after).order_by('pk').values('pk', 'first_name', 'number')
+    if limit is not None:
+        contacts = contacts[:limit]
+    return [{'pk': c['pk'], 'first_name': c['first_name'], 'number': str(c['number'])} for c in contacts]
+
+
+def send_group(body, group_name, sent_by):
+    """Send a message to a group, tracked by a new `SendJob`."""
+    group = RecipientGroup.objects.filter(name=group_name, is_archived=False).first()
+    if group is None:
+        return None
+    job = create_send_job(group, body, sent_by)
+    queue_chunk(job.pk)
+    return job
+
+
+def create_send_job(group, body, sent_by):
+    return SendJob.objects.create(
+        content=body,
+        sent_by=sent_by,
+        recipient_group=group,
+        total=sendable_recipients(group).count(),
+    )
+
+
+def _next_lease(job_pk, *conditions, **updates):
+    """
+    Lease a job to the next chunk task, if `conditions` hold.
+
+    Returns the new lease token, or None. Any other task still queued for
+    the job gives up when it starts.
+    """
+    token = uuid4().hex
+    now = timezone.now()
+    leased = SendJob.objects.filter(*conditions, pk=job_pk).update(
+        lease_owner=token, lease_expires=now + JOB_QUEUED_LEASE, updated=now, **updates
+    )
+    return token if leased else None
+
+
+def queue_chunk(job_pk, *conditions, **updates):
+    """Queue a task to send the next chunk of a job, if `conditions` hold."""
+    token = _next_lease(job_pk, *conditions, **updates)
+    if token is not None:
+        async('apostello.tasks.send_job_chunk_task', job_pk, token)
+    return token is not None
+
+
+def send_job_chunk(job_pk, token=None):
+    """
+    Send the next chunk of a job, then queue the chunk after it.
+
+    The task only sends while it holds the lease on the job. The chunk's
+    recipients are claimed before anything is sent, and the messages,
+    claims and job are written together once the chunk is sent, so a
+    chunk that is run again after a worker dies does not send to anyone
+    twice. Recipients claimed by a worker that died mid chunk are not
+    retried, as we cannot tell if Twilio got them.
+    """
+    now = timezone.now()
+    lease = Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+    if token is not None:
+        lease |= Q(lease_owner=token)
+    token = token or uuid4().hex
+    acquired = SendJob.objects.filter(lease, pk=job_pk).exclude(status=SendJob.COMPLETE).update(
+        lease_owner=token, lease_expires=now + JOB_LEASE, updated=now
+    )
+    if not acquired:
+        return
+    job = SendJob.objects.select_related('recipient_group').get(pk=job_pk)
+    recipients = []
+    if job.recipient_group is not None:
+        recipients = group_recipients(job.recipient_group, after=job.checkpoint, limit=chunk_size())
+    if not recipients:
+        SendJob.objects.filter(pk=job.pk, lease_owner=token).update(
+            status=SendJob.COMPLETE, lease_owner='', lease_expires=None, updated=timezone.now()
+        )
+        return
+
+    claimed = SendJobRecipient.objects.filter(send_job=job, recipient_id__in=[r['pk'] for r in recipients])
+    already_claimed = set(claimed.values_list('recipient_id', flat=True))
+    recipients_to_send = [r for r in recipients if r['pk'] not in already_claimed]
+    try:
+        with transaction.atomic():
+            SendJobRecipient.objects.bulk_create(
+                SendJobRecipient(send_job=job, recipient_id=r['pk']) for r in recipients_to_send
+            )
+    except IntegrityError:
+        # another task is sending this chunk, despite the lease
+        logger.warning('Send job %s chunk after %s already claimed, stopping', job.pk, job.checkpoint)
+        return
+
+    sms, num_failed = send_messages(
+        recipients_to_send,
+        job.content,
+        job.sent_by,
+        group_pk=job.recipient_group_id,
+        send_job_pk=job.pk,
+    )
+    sent_to = {m.recipient_id for m in sms}
+    failed_to = [r['pk'] for r in recipients_to_send if r['pk'] not in sent_to]
+    counters = {'sent': F('sent') + len(sms), 'failed': F('failed') + num_failed}
+    with transaction.atomic():
+        SmsOutbound.objects.bulk_create(sms)
+        claimed.filter(recipient_id__in=sent_to).update(status=SendJobRecipient.SENT)
+        claimed.filter(recipient_id__in=failed_to).update(status=SendJobRecipient.FAILED)
+        next_token = _next_lease(
+            job.pk, Q(lease_owner=token), status=SendJob.SENDING, checkpoint=recipients[-1]['pk'], **counters
+        )
+        if next_token is None:
+            SendJob.objects.filter(pk=job.pk).update(**counters)
+    delivery_status.apply_unmatched(m.sid for m in sms)
+    if next_token is None:
+        logger.warning('Lost the lease on send job %s, stopping', job.pk)
+        return
+    async('apostello.tasks.send_job_chunk_task', job.pk, next_token)
+
+
+def resume_send_jobs():
+    """Restart jobs whose lease has run out, as the task holding it has died."""
+    now = timezone.now()
+    stalled = SendJob.objects.exclude(status=SendJob.COMPLETE).filter(
+        Q(lease_expires__lt=now) | Q(lease_expires__isnull=True, updated__lt=now - JOB_QUEUED_LEASE)
+    )
+    for job in stalled:
+        # only one resume per job, even if this runs twice at once
+        if queue_chunk(job.pk, Q(updated=job.updated)):
+            logger.info('Resuming send job %s after recipient %s', job.pk, job.checkpoint)
+
+
+def claim_queued(limit, now=None):
+    """
+    Claim up to `limit` due queued messages, returning their pks.
+
+    Rows locked by another worker are skipped rather than waited on, so
+    several workers can claim at once without getting the same rows.
+    Claims that were never finished are up for grabs again after a while.
+    """
+    if now is None:
+        now = timezone.now()
+    with transaction.atomic():
+        pks = list(
+            QueuedSms.objects.select_for_update(skip_locked=True).filter(
+                sent=False,
+                failed=False,
+                time_to_send__lte=now,
+            ).filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - STALE_CLAIM_AGE))
+            .order_by('time_to_send', 'pk').values_list('pk', flat=True)[:limit]
+        )
+        QueuedSms.objects.filter(pk__in=pks).update(claimed_at=now)
+    return pks
+
+
+def next_due():
+    """When the next unclaimed queued message is due, or None."""
+    return QueuedSms.objects.filter(
+        sent=False,
+        failed=False,
+        claimed_at__isnull=True,
+    ).order_by('time_to_send').values_list('time_to_send', flat=True).first()
+
+
+def dispatch_queued():
+    """Claim all due queued messages, in batches, and queue a send task for each batch."""
+    num_claimed = 0
+    while True:
+        # the claim time is the token the send task checks it still holds
+        claimed_at = timezone.now()
+        pks = claim_queued(chunk_size(), now=claimed_at)
+        if not pks:
+            return num_claimed
+        num_claimed += len(pks)
+        async('apostello.tasks.send_queued_task', pks, claimed_at)
+
+
+def send_queued(pks, claimed_at=None):
+    """
+    Send queued messages.
+
+    Given `claimed_at`, only messages still held by that claim are sent,
+    so a task whose claim went stale and was taken over sends nothing.
+    Messages with the same content, sender and group are sent together.
+    Each batch's outbound log and queued messages are updated in one
+    transaction. A message to a whole group is handed to a new send job.
+    """
+    queued = QueuedSms.objects.filter(
+        pk__in=pks,
+        sent=False,
+        failed=False,
+    ).select_related('recipient', 'recipient_group')
+    if claimed_at is not None:
+        queued = queued.filter(claimed_at=claimed_at)
+    batches = {}
+    skipped = []
+    jobs = []
+    for sms in queued:
+        if sms.is_group_send:
+            jobs.append(sms)
+            continue
+        if sms.recipient is None or sms.recipient.is_archived:
+            # if recipient is not active, fail silently
+            skipped.append(sms.pk)
+            continue
+        batches.setdefault((sms.content, sms.sent_by, sms.recipient_group_id), []).append(sms)
+    QueuedSms.objects.filter(pk__in=skipped).update(sent=True)
+
+    num_sent = len(skipped)
+    num_failed = 0
+    for (body, sent_by, group_pk), rows in batches.items():
+        recipients = [
+            {
+                'pk': sms.recipient.pk,
+                'first_name': sms.recipient.first_name,
+                'number': str(sms.recipient.number),
+            } for sms in rows
+        ]
+        sms_out, _ = send_messages(recipients, body, sent_by, group_pk=group_pk)
+        sent_to = Counter(m.recipient_id for m in sms_out)
+        sent_pks = []
+        failed_pks = []
+        for sms in rows:
+            if sent_to[sms.recipient_id]:
+                sent_to[sms.recipient_id] -= 1
+                sent_pks.append(sms.pk)
+            else:
+                failed_pks.append(sms.pk)
+        with transaction.atomic():
+            SmsOutbound.objects.bulk_create(sms_out)
+            QueuedSms.objects.filter(pk__in=sent_pks).update(sent=True)
+            QueuedSms.objects.filter(pk__in=failed_pks).update(failed=True)
+        delivery_status.apply_unmatched(m.sid for m in sms_out)
+        num_sent += len(sent_pks)
+        num_failed += len(failed_pks)
+
+    for sms in jobs:
+        with transaction.atomic():
+            if not QueuedSms.objects.filter(pk=sms.pk, sent=False).update(sent=True):
+                continue
+            job = create_send_job(sms.recipient_group, sms.content, sms.sent_by)
+        queue_chunk(job.pk)
+        num_sent += 1
+    return {'sent': num_sent, 'failed': num_failed}
+
+
+def send_messages(recipients, body, sent_by, group_pk=None, send_job_pk=None):
+    """
+    Send a personalised message to each recipient.
+
+    Each recipient is sent from their number in the sending pool. Up to
+    SMS_SEND_CONCURRENCY messages per sending number are sent at once,
+    each number paced by its own send rate limit. A failure for one
+    recipient is logged and does not stop the rest. Returns unsaved
+    `SmsOutbound`s for the messages that were sent, and the number that
+    failed.
+    """
+    client = get_twilio_client()
+    numbers = number_pool.sending_numbers()
+    buckets = {from_: TokenBucket(from_) for from_ in numbers}
+
+    def send_one(recipient):
+        # runs on a pool thread, so no database access in here
+        content = body.replace('%name%', recipient['first_name'])
+        from_ = number_pool.number_for(recipient['number'], numbers)
+        try:
+            return content, create_message(client, content, recipient['number'], from_, bucket=buckets.get(from_))
+        except TwilioRestException as e:
+            return content, e
+
+    workers = settings.SMS_SEND_CONCURRENCY * max(len(numbers), 1)
+    if workers > 1 and len(recipients) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(recipients))) as executor:
+            results = list(executor.map(send_one, recipients))
+    else:
+        results = [send_one(r) for r in recipients]
+
+    sent = []
+    num_failed = 0
+    for recipient, (content, message) in zip(recipients, results):
+        if isinstance(message, TwilioRestException):
+            num_failed += 1
+            if message.code == BLACKLISTED_ERROR_CODE:
+                Recipient.objects.filter(pk=recipient['pk']).update(is_blocking=True)
+                async('apostello.tasks.blacklist_notify', recipient['pk'], '', 'stop')
+            else:
+                logger.error('Could not send sms', exc_info=message, extra={'recipient': recipient['pk']})
+            continue
+        sent.append(
+            SmsOutbound(
+                sid=message.sid,
+                content=content,
+                time_sent=timezone.now(),
+                recipient_id=recipient['pk'],
+                recipient_group_id=group_pk,
+                sent_by=sent_by,
+                send_job_id=send_job_pk,
+                status=message.status or '',
+            )
+        )
+
+    return sent, num_failed
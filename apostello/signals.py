@@ -1,10 +1,12 @@
 from allauth.account.signals import user_signed_up
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 
+from apostello import number_pool
 from apostello.tasks import send_async_mail
 from apostello.models import UserProfile
+from site_config.models import SendingNumber
 
 
 @receiver(user_signed_up)
@@ -32,3 +34,10 @@ def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.create(user=instance)
     instance.profile.save()
+
+
+@receiver(post_save, sender=SendingNumber)
+@receiver(post_delete, sender=SendingNumber)
+def clear_number_pool(sender, **kwargs):
+    """Forget the cached number pool, signals also cover queryset deletes."""
+    number_pool.clear_cache()
@@ -1,5 +1,6 @@
 import json
 import logging
+import time
 
 import requests
 from django.conf import settings
@@ -19,17 +20,47 @@ logger = logging.getLogger('apostello')
 
 def group_send_message_task(body, group_name, sent_by, eta):
     """Send message to all members of group."""
-    from apostello.models import Recipient, RecipientGroup
-    group = RecipientGroup.objects.filter(name=group_name, is_archived=False)
+    if eta is None:
+        from apostello import sending
+        sending.send_group(body, group_name, sent_by)
+        return
+
+    from apostello.models import QueuedSms, RecipientGroup
+    group = RecipientGroup.objects.filter(name=group_name, is_archived=False).first()
+    if group is None:
+        return
+    # members are looked up when the message is sent
+    QueuedSms.objects.create(time_to_send=eta, content=body, sent_by=sent_by, recipient_group=group)
+
+
+def flush_sms_status_updates():
+    """Write delivery status callbacks to the outgoing log."""
+    from apostello import delivery_status
+    delivery_status.flush()
+
+
+def sweep_sms_status_updates():
+    """Flush delivery status callbacks, and retry those that arrived before their message was logged."""
+    from apostello import delivery_status
+    delivery_status.flush()
+    delivery_status.retry_unmatched()
+
+
+def send_job_chunk_task(job_pk, token=None):
+    """Send the next chunk of a group send."""
+    from apostello import sending
+    sending.send_job_chunk(job_pk, token)
 
-    for recipient in Recipient.objects.filter(groups__in=group):
-        recipient.send_message(content=body, group=group_name, sent_by=sent_by, eta=eta)
+
+def resume_send_jobs():
+    """Pick up group sends interrupted by a dead worker."""
+    from apostello import sending
+    sending.resume_send_jobs()
 
 
 def recipient_send_message_task(recipient_pk, body, group, sent_by):
     """Send a message asynchronously."""
     from apostello.models import Recipient
-    from site_config.models import SiteConfiguration
     recipient = Recipient.objects.get(pk=recipient_pk)
     if recipient.is_archived:
         # if recipient is not active, fail silently
@@ -40,14 +71,23 @@ def recipient_send_message_task(recipient_pk, body, group, sent_by):
     body = recipient.personalise(body)
     # send twilio message
     try:
-        message = get_twilio_client().messages.create(
-            body=body, to=str(recipient.number), from_=str(SiteConfiguration.get_solo().twilio_from_num)
-        )
+        from apostello.number_pool import number_for
+        from apostello.sending import create_message
+        message = create_message(get_twilio_client(), body, str(recipient.number), number_for(recipient.number))
         # add to sms out table
-        sms = SmsOutbound(sid=message.sid, content=body, time_sent=timezone.now(), recipient=recipient, sent_by=sent_by)
+        sms = SmsOutbound(
+            sid=message.sid,
+            content=body,
+            time_sent=timezone.now(),
+            recipient=recipient,
+            sent_by=sent_by,
+            status=message.status or '',
+        )
         if group is not None:
             sms.recipient_group = RecipientGroup.objects.filter(name=group)[0]
         sms.save()
+        from apostello import delivery_status
+        delivery_status.apply_unmatched([sms.sid])
     except TwilioRestException as e:
         if e.code == 21610:
             recipient.is_blocking = True
@@ -59,9 +99,14 @@ def recipient_send_message_task(recipient_pk, body, group, sent_by):
 
 def send_queued_sms():
     """Check for and send any queued messages."""
-    from apostello.models import QueuedSms
-    for sms in QueuedSms.objects.filter(sent=False, time_to_send__lte=timezone.now()):
-        sms.send()
+    from apostello import sending
+    sending.dispatch_queued()
+
+
+def send_queued_task(pks, claimed_at=None):
+    """Send a batch of claimed queued messages."""
+    from apostello import sending
+    sending.send_queued(pks, claimed_at)
 
 
 def ask_for_name(person_from_pk, sms_body, ask_for_name):
@@ -89,6 +134,40 @@ def ask_for_name(person_from_pk, sms_body, ask_for_name):
         )
 
 
+# inbound pipeline
+
+
+def process_inbound(p, t, contact_pk, classified, send_name_sms):
+    """
+    Run all the background work for an incoming message in a single task.
+
+    Stages run in order and are isolated from each other, so a failing stage
+    (e.g. slack being down) is logged and does not stop the others.
+    Returns the time taken by each stage.
+    """
+    from apostello.models import Recipient
+    contact = Recipient.objects.get(pk=contact_pk)
+    sms_body = p['Body'].strip()
+    stages = (
+        ('log_msg_in', log_msg_in, (p, t, contact_pk, classified)),
+        ('sms_to_slack', sms_to_slack, (sms_body, str(contact), classified.keyword_name)),
+        ('blacklist_notify', blacklist_notify, (contact_pk, sms_body, classified.keyword)),
+        ('ask_for_name', ask_for_name, (contact_pk, sms_body, send_name_sms)),
+        ('send_cloud_messages', send_cloud_messages, ()),
+    )
+    timings = {}
+    for name, func, args in stages:
+        start = time.perf_counter()
+        try:
+            func(*args)
+        except Exception:
+            logger.error('Inbound stage %s failed', name, exc_info=True, extra={'sid': p.get('MessageSid')})
+        timings[name] = time.perf_counter() - start
+        logger.info('Inbound stage %s took %.3fs', name, timings[name])
+
+    return timings
+
+
 # SMS logging and consistency checks
 
 
@@ -98,28 +177,40 @@ def check_incoming_log():
     check_incoming_log()
 
 
+def check_incoming_sms(sid):
+    """Verify a single incoming message."""
+    from apostello.logs import check_incoming_sms
+    check_incoming_sms(sid)
+
+
 def check_outgoing_log():
     """Update outgoing log."""
     from apostello.logs import check_outgoing_log
     check_outgoing_log()
 
 
-def log_msg_in(p, t, from_pk):
-    """Log incoming message."""
+def log_msg_in(p, t, from_pk, classified=None):
+    """
+    Log incoming message.
+
+    `classified` is the ClassifiedSms computed when the message arrived, if
+    it is not passed the message is classified again.
+    """
     from apostello.models import Keyword, SmsInbound, Recipient
     from_ = Recipient.objects.get(pk=from_pk)
-    matched_keyword = Keyword.match(p['Body'].strip())
+    if classified is None:
+        classified = Keyword.classify(p['Body'].strip())
     SmsInbound.objects.create(
         sid=p['MessageSid'],
         content=p['Body'],
         time_received=t,
         sender_name=str(from_),
         sender_num=p['From'],
-        matched_keyword=str(matched_keyword),
-        matched_colour=Keyword.lookup_colour(p['Body'].strip())
+        matched_keyword=classified.keyword_name,
+        matched_colour=classified.colour,
     )
-    # check log is consistent:
-    async('apostello.tasks.check_incoming_log')
+    # check this message is consistent with the log:
+    async('apostello.tasks.check_incoming_sms', p['MessageSid'])
 
 
 def update_msgs_name(person_pk):
@@ -128,9 +219,7 @@ def update_msgs_name(person_pk):
     person_ = Recipient.objects.get(pk=person_pk)
     name = str(person_)
     number = str(person_.number)
-    for sms in SmsInbound.objects.filter(sender_num=number):
-        sms.sender_name = name
-        sms.save()
+    SmsInbound.objects.filter(sender_num=number).update(sender_name=name)
 
 
 def cleanup_expired_sms():
@@ -1,17 +1,96 @@
+import threading
 from functools import wraps
 
 from django.conf import settings
 from django.http import (HttpRequest, HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed)
+from django.utils.module_loading import import_string
 from django.views.decorators.csrf import csrf_exempt
+from requests import Session
+from requests.adapters import HTTPAdapter
+from twilio.http import HttpClient
+from twilio.http.response import Response
 from twilio.request_validator import RequestValidator
 from twilio.rest import Client
 
+from apostello import number_pool
 from site_config.models import ConfigurationError, SiteConfiguration
 
+_client_lock = threading.Lock()
+# ((backend, sid, auth token, pool size), client) for this process
+_client = (None, None)
+
+
+class PooledHttpClient(HttpClient):
+    """
+    Twilio http client that keeps connections open between requests.
+
+    Twilio's default client opens a new session, and so a new TLS
+    connection, for every request.
+    """
+
+    def __init__(self, pool_size):
+        self.session = Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None,
+                allow_redirects=False):
+        response = self.session.request(
+            method.upper(),
+            url,
+            params=params,
+            data=data,
+            headers=headers,
+            auth=auth,
+            timeout=timeout,
+            allow_redirects=allow_redirects,
+        )
+        return Response(int(response.status_code), response.text)
+
+
+def http_pool_size():
+    """
+    Number of connections to Twilio to keep open.
+
+    Group sends run SMS_SEND_CONCURRENCY threads per sending number, and
+    each needs a pooled connection, or it opens a new one for every
+    message.
+    """
+    if not settings.TWILIO_HTTP_POOL_SIZE:
+        return 0
+    send_threads = settings.SMS_SEND_CONCURRENCY * max(len(number_pool.sending_numbers()), 1)
+    return max(settings.TWILIO_HTTP_POOL_SIZE, send_threads)
+
+
+def build_twilio_client(sid, auth_token):
+    """Default sms backend, talks to Twilio."""
+    http_client = None
+    pool_size = http_pool_size()
+    if pool_size:
+        http_client = PooledHttpClient(pool_size)
+    return Client(sid, auth_token, http_client=http_client)
+
 
 def get_twilio_client():
+    """
+    Return this process's Twilio client.
+
+    The client is built by the SMS_BACKEND setting, and reused until the
+    backend, the credentials in the site configuration or the connection
+    pool size change.
+    """
+    global _client
     twilio_settings = SiteConfiguration.get_twilio_settings()
-    return Client(twilio_settings['sid'], twilio_settings['auth_token'])
+    key = (settings.SMS_BACKEND, twilio_settings['sid'], twilio_settings['auth_token'], http_pool_size())
+    cached_key, client = _client
+    if cached_key == key:
+        return client
+
+    with _client_lock:
+        cached_key, client = _client
+        if cached_key != key:
+            client = import_string(settings.SMS_BACKEND)(twilio_settings['sid'], twilio_settings['auth_token'])
+            _client = (key, client)
+        return client
 
 
 def twilio_view(f):
@@ -18,7 +18,10 @@ urlpatterns = [
 ]
 
 # twilio api url
-urlpatterns += [url(r'^sms/$', v.sms)]
+urlpatterns += [
+    url(r'^sms/$', v.sms),
+    url(r'^sms/status/$', v.sms_status),
+]
 
 # auth and admin
 urlpatterns += [
@@ -14,10 +14,9 @@ def validate_lower(value):
 
 
 def not_twilio_num(value):
-    """Ensure value does not match the sending number."""
-    from site_config.models import SiteConfiguration
-    twilio_num = str(SiteConfiguration.get_solo().twilio_from_num)
-    if str(value) == twilio_num:
+    """Ensure value does not match any of our sending numbers."""
+    from apostello.number_pool import our_numbers
+    if str(value) in our_numbers():
         raise ValidationError("You cannot add the number from which we send messages. Inception!")
 
 
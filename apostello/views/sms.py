@@ -3,6 +3,7 @@ import logging
 from django.http import HttpResponse
 from twilio.twiml.messaging_response import MessagingResponse
 
+from apostello import delivery_status
 from apostello.reply import InboundSms
 from apostello.twilio import twilio_view
 from site_config.models import SiteConfiguration
@@ -25,7 +26,23 @@ def sms(request):
     config = SiteConfiguration.get_solo()
     if msg.reply and not config.disable_all_replies:
         logger.info('Add reply (%s) to response', msg.reply)
+        # sent from the number they texted, not their number in the pool
         r.message(msg.reply)
 
     logger.info('Return response to Twilio')
     return HttpResponse(str(r), content_type='application/xml')
+
+
+@twilio_view
+def sms_status(request):
+    """
+    Handle delivery status callbacks from Twilio.
+
+    Updates are queued and written in batches, Twilio can call back many
+    times a second during a group send.
+    """
+    sid = request.POST.get('MessageSid')
+    status = request.POST.get('MessageStatus')
+    if sid and status:
+        delivery_status.record(sid, status)
+    return HttpResponse(status=204)
@@ -288,7 +288,7 @@ decodeRecipientGroup =
         |> required "description" Decode.string
         |> optional "members" (Decode.list decodeRecipientSimple) []
         |> optional "nonmembers" (Decode.list decodeRecipientSimple) []
-        |> required "cost" Decode.float
+        |> optional "cost" Decode.float 0
         |> required "is_archived" Decode.bool
 
 
@@ -389,8 +389,9 @@ type alias QueuedSms =
     , sent : Bool
     , failed : Bool
     , content : String
-    , recipient : Recipient
+    , recipient : Maybe Recipient
     , recipient_group : Maybe RecipientGroup
+    , recipient_count : Int
     , sent_by : String
     }
 
@@ -404,8 +405,9 @@ decodeQueuedSms =
         |> required "sent" Decode.bool
         |> required "failed" Decode.bool
         |> required "content" Decode.string
-        |> required "recipient" decodeRecipient
+        |> required "recipient" (Decode.maybe decodeRecipient)
         |> required "recipient_group" (Decode.maybe decodeRecipientGroup)
+        |> required "recipient_count" Decode.int
         |> required "sent_by" Decode.string
 
 
@@ -418,8 +420,9 @@ encodeQueuedSms sms =
         , ( "sent", Encode.bool sms.sent )
         , ( "failed", Encode.bool sms.failed )
         , ( "content", Encode.string sms.content )
-        , ( "recipient", encodeRecipient sms.recipient )
+        , ( "recipient", encodeMaybe encodeRecipient sms.recipient )
         , ( "recipient_group", encodeMaybe encodeRecipientGroup sms.recipient_group )
+        , ( "recipient_count", Encode.int sms.recipient_count )
         , ( "sent_by", Encode.string sms.sent_by )
         ]
 
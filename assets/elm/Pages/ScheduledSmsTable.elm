@@ -69,7 +69,7 @@ smsRow props sms =
     ( toString sms.pk
     , tr [ A.style style ]
         [ td [] [ text sms.sent_by ]
-        , td [] [ props.contactLink sms.recipient ]
+        , td [] [ recipientCell props sms ]
         , td [] [ groupLink props sms.recipient_group ]
         , td [] [ text sms.content ]
         , td [] [ text sms.time_to_send_formatted ]
@@ -78,6 +78,16 @@ smsRow props sms =
     )
 
 
+recipientCell : Props msg -> QueuedSms -> Html msg
+recipientCell props sms =
+    case sms.recipient of
+        Just recipient ->
+            props.contactLink recipient
+
+        Nothing ->
+            text <| toString sms.recipient_count ++ " recipients"
+
+
 groupLink : Props msg -> Maybe RecipientGroup -> Html msg
 groupLink props group =
     case group of
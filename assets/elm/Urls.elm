@@ -106,6 +106,11 @@ api_act_send_group =
     "/api/v2/actions/sms/send/group/"
 
 
+api_act_sms_cost_preview : String
+api_act_sms_cost_preview =
+    "/api/v2/actions/sms/cost/"
+
+
 api_act_update_group_members : Int -> String
 api_act_update_group_members pk =
     "/api/v2/actions/group/update_members/" ++ toString pk ++ "/"
@@ -148,6 +153,11 @@ api_keywords keyword =
            )
 
 
+api_log_sync_status : String
+api_log_sync_status =
+    "/api/v2/logs/sync/"
+
+
 api_out_log : String
 api_out_log =
     "/api/v2/sms/out/"
@@ -187,6 +197,18 @@ api_recipients_import_csv =
     "/api/v2/recipients/import/csv/"
 
 
+api_send_jobs : Maybe Int -> String
+api_send_jobs pk =
+    "/api/v2/send_jobs/"
+        ++ (case pk of
+                Just b ->
+                    toString b ++ "/"
+
+                Nothing ->
+                    ""
+           )
+
+
 api_setup : String
 api_setup =
     "/api/v2/setup/"
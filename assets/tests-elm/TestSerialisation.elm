@@ -147,8 +147,9 @@ queuedSms =
         |> Fuzz.andMap Fuzz.bool
         |> Fuzz.andMap Fuzz.bool
         |> Fuzz.andMap Fuzz.string
-        |> Fuzz.andMap recipient
+        |> Fuzz.andMap (Fuzz.maybe recipient)
         |> Fuzz.andMap (Fuzz.maybe recipientGroup)
+        |> Fuzz.andMap Fuzz.int
         |> Fuzz.andMap Fuzz.string
 
 
@@ -163,6 +163,31 @@ ONEBODY_WAIT_TIME = 10
 # Sms settings - note that messages over 160 will be charged twice
 MAX_NAME_LENGTH = 16
 SMS_CHAR_LIMIT = 160 - MAX_NAME_LENGTH + len('{name}')
+# builds the client used to send and fetch sms, called with the account sid
+# and auth token. Use apostello.fake_twilio.FakeClient to run without Twilio
+SMS_BACKEND = os.environ.get('SMS_BACKEND', 'apostello.twilio.build_twilio_client')
+# behaviour of the fake backend
+FAKE_SMS_LATENCY = float(os.environ.get('FAKE_SMS_LATENCY', 0))
+FAKE_SMS_ERROR_RATE = float(os.environ.get('FAKE_SMS_ERROR_RATE', 0))
+FAKE_SMS_RATE_LIMIT = float(os.environ.get('FAKE_SMS_RATE_LIMIT', 0))
+# number of connections to Twilio kept open per process, 0 to disable pooling
+TWILIO_HTTP_POOL_SIZE = 10
+# full url of the sms/status/ endpoint, e.g. https://apostello.example.com/sms/status/
+# if set, Twilio reports delivery updates there as they happen
+TWILIO_STATUS_CALLBACK_URL = os.environ.get('TWILIO_STATUS_CALLBACK_URL')
+# outbound sms per second allowed from each of our numbers, shared by all
+# workers, and how many may go at once before the rate kicks in.
+# Set the rate to 0 to let Twilio do the queueing
+SMS_SEND_RATE = float(os.environ.get('SMS_SEND_RATE', 1))
+SMS_SEND_BURST = int(os.environ.get('SMS_SEND_BURST', 1))
+# group sends are split into tasks of at most this many recipients
+SMS_SEND_CHUNK_SIZE = 100
+# and each task sends for no longer than this at the send rate, so it stays
+# well inside the django-q timeout and other tasks get a turn in between
+SMS_SEND_CHUNK_SECONDS = 20
+# number of sms a task sends at once from each of our numbers, limits open
+# requests to Twilio
+SMS_SEND_CONCURRENCY = 8
 # Used for nomalising elvanto imports, use twilio to limit sending to
 # particular countries:
 # https://www.twilio.com/help/faq/voice/what-are-global-permissions-and-why-do-they-exist
@@ -181,6 +206,11 @@ SOLO_CACHE = 'default'
 CM_SERVER_KEY = os.environ.get('CM_SERVER_KEY', '')
 CM_SENDER_ID = os.environ.get('CM_SENDER_ID', '')
 
+# expired sms are deleted in batches, with a pause (in seconds) between
+# batches so other queries can get at the tables
+SMS_CLEANUP_BATCH_SIZE = 1000
+SMS_CLEANUP_PAUSE = 0.1
+
 # maximum number of SMS to send to clients from api
 # if this is too large it may crash the elm run time
 MAX_SMS_N = os.environ.get('MAX_SMS_TO_CLIENT', 5000)
@@ -53,6 +53,11 @@ DJANGO_TWILIO_FORGERY_PROTECTION = True
 
 ONEBODY_WAIT_TIME = 1
 
+SMS_CLEANUP_PAUSE = 0
+# connections kept open between tests would outlive their vcr cassettes
+TWILIO_HTTP_POOL_SIZE = 0
+SMS_SEND_RATE = 0
+
 EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
 ACCOUNT_DEFAULT_HTTP_PROTOCOL = 'http'
 
@@ -5,3 +5,8 @@ from . import models
 
 admin.site.register(models.SiteConfiguration, SingletonModelAdmin)
 admin.site.register(models.DefaultResponses, SingletonModelAdmin)
+
+
+@admin.register(models.SendingNumber)
+class SendingNumberAdmin(admin.ModelAdmin):
+    list_display = ('number', 'is_active')
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+import phonenumber_field.modelfields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('site_config', '0017_auto_20171215_1105'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendingNumber',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', phonenumber_field.modelfields.PhoneNumberField(help_text='A number in your Twilio account.', max_length=128, unique=True)),
+                ('is_active', models.BooleanField(default=True, help_text='Untick to stop sending from this number. Replies to it will still be received.')),
+            ],
+            options={
+                'ordering': ['number'],
+            },
+        ),
+    ]
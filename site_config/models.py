@@ -149,7 +149,7 @@ class SiteConfiguration(SingletonModel):
 
     def save(self, *args, **kwargs):
         super(SiteConfiguration, self).save(*args, **kwargs)
-        cache.delete('twilio_settings')
+        cache.delete_many(['twilio_settings', 'sending_numbers'])
 
     def is_twilio_setup(self):
         vals = [
@@ -193,6 +193,26 @@ class SiteConfiguration(SingletonModel):
         verbose_name = "Site Configuration"
 
 
+class SendingNumber(models.Model):
+    """
+    An extra Twilio number to send from.
+
+    Group sends are spread across these and the main Twilio number. Each
+    contact is always sent messages from the same number.
+    """
+    number = PhoneNumberField(unique=True, help_text='A number in your Twilio account.')
+    is_active = models.BooleanField(
+        default=True, help_text='Untick to stop sending from this number. Replies to it will still be received.'
+    )
+
+    def __str__(self):
+        """Pretty representation."""
+        return str(self.number)
+
+    class Meta:
+        ordering = ['number']
+
+
 class DefaultResponses(SingletonModel):
     """
     Stores the site wide default responses.
@@ -12,6 +12,7 @@ from django.utils.timezone import get_current_timezone
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
 
+from apostello import keyword_index
 from apostello.models import *
 from site_config.models import SiteConfiguration
 
@@ -43,6 +44,12 @@ def short_circuit_q(monkeypatch):
     monkeypatch.setattr('django_q.tasks.schedule.__code__', new_async.__code__)
 
 
+@pytest.fixture(autouse=True)
+def fresh_keyword_index():
+    """Rebuild the keyword index, the test db is rolled back without saves."""
+    keyword_index.invalidate()
+
+
 @pytest.fixture
 def recipients():
     """Create a bunch of recipients for testing."""
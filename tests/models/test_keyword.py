@@ -2,6 +2,8 @@ from datetime import datetime
 
 import pytest
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from apostello.models import Keyword, SmsInbound
@@ -89,9 +91,39 @@ class TestKeywords():
     def test_no_match(self, keywords):
         assert Keyword.match("nope") == 'No Match'
 
+    def test_match_no_queries_when_index_built(self, keywords):
+        Keyword.match("test matching")
+        with CaptureQueriesContext(connection) as ctx:
+            assert str(Keyword.match("2test matching")) == "2test"
+            assert Keyword.match("nope") == 'No Match'
+        assert len(ctx.captured_queries) == 0
+
+    def test_match_index_invalidated_on_save(self, keywords):
+        assert Keyword.match("newkw please") == 'No Match'
+        Keyword.objects.create(keyword='newkw', description='new keyword')
+        assert str(Keyword.match("newkw please")) == 'newkw'
+
+    def test_match_index_invalidated_on_delete(self, keywords):
+        assert str(Keyword.match("2test")) == '2test'
+        keywords['test2'].delete()
+        assert Keyword.match("2test") == 'No Match'
+
     def test_lookup_colour_test(self, keywords):
         assert Keyword.lookup_colour('test') == '#098f6b'
 
+    def test_classify(self, keywords):
+        classified = Keyword.classify('test matching')
+        assert classified.keyword == keywords['test']
+        assert classified.keyword_name == 'test'
+        assert classified.reserved is None
+        assert classified.colour == '#098f6b'
+
+    def test_classify_reserved(self):
+        classified = Keyword.classify('stop it')
+        assert classified.keyword == 'stop'
+        assert classified.reserved == 'stop'
+        assert classified.colour == '#FFCDD2'
+
     def test_stop(self):
         assert Keyword.match("Stop it!") == 'stop'
         assert Keyword.match("stop    ") == 'stop'
@@ -1,7 +1,14 @@
+from datetime import timedelta
+
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from tests.conftest import twilio_vcr
 
+from apostello.models import Recipient, SmsInbound
+from apostello.tasks import update_msgs_name
+
 
 @pytest.mark.django_db
 class TestRecipient:
@@ -30,3 +37,89 @@ class TestRecipient:
 
     def test_send_archived(self, recipients):
         recipients['knox'].send_message('test')
+
+    def test_sender_changed(self, recipients):
+        calvin = Recipient.objects.get(pk=recipients['calvin'].pk)
+        assert not calvin.sender_changed()
+        calvin.notes = 'new notes'
+        assert not calvin.sender_changed()
+        calvin.first_name = 'Jean'
+        assert calvin.sender_changed()
+        assert Recipient(first_name='New', last_name='Person').sender_changed()
+
+    def test_number_change_backdates_messages(self, recipients, monkeypatch):
+        queued = []
+        monkeypatch.setattr('apostello.models.async', lambda *args, **kwargs: queued.append(args))
+        calvin = Recipient.objects.get(pk=recipients['calvin'].pk)
+        calvin.number = '+447927401111'
+        calvin.save()
+        assert queued == [('apostello.tasks.update_msgs_name', calvin.pk)]
+
+    def test_rename_backdates_messages(self, recipients, monkeypatch):
+        queued = []
+        monkeypatch.setattr('apostello.models.async', lambda *args, **kwargs: queued.append(args))
+        calvin = Recipient.objects.get(pk=recipients['calvin'].pk)
+        calvin.notes = 'not a rename'
+        calvin.save()
+        assert queued == []
+
+        calvin.first_name = 'Jean'
+        calvin.save()
+        assert queued == [('apostello.tasks.update_msgs_name', calvin.pk)]
+        assert str(calvin) == 'Jean Calvin'
+        # saving again without another change does nothing
+        calvin.save()
+        assert len(queued) == 1
+
+    def test_update_msgs_name_single_update(self, recipients, smsin):
+        calvin = recipients['calvin']
+        Recipient.objects.filter(pk=calvin.pk).update(first_name='Jean')
+        with CaptureQueriesContext(connection) as queries:
+            update_msgs_name(calvin.pk)
+        assert len([q for q in queries if q['sql'].startswith('UPDATE')]) == 1
+        assert set(SmsInbound.objects.filter(sender_num=str(calvin.number)).values_list('sender_name', flat=True)
+                   ) == {'Jean Calvin'}
+
+    def test_last_sms(self, recipients):
+        calvin = recipients['calvin']
+        assert calvin.last_sms == {'content': '', 'time_received': ''}
+        now = timezone.now()
+        for sid, content, t in [('sms1', 'newest', now), ('sms2', 'older', now - timedelta(hours=1))]:
+            SmsInbound.objects.create(
+                sid=sid, content=content, time_received=t, sender_name='John Calvin', sender_num=str(calvin.number)
+            )
+        calvin.refresh_from_db()
+        assert calvin.last_sms['content'] == 'newest'
+
+    def test_new_contact_gets_last_sms(self, recipients):
+        SmsInbound.objects.create(
+            sid='sms1', content='hello', time_received=timezone.now(), sender_name='', sender_num='+447927401111'
+        )
+        contact = Recipient.objects.create(first_name='New', last_name='Person', number='+447927401111')
+        contact.refresh_from_db()
+        assert contact.last_sms['content'] == 'hello'
+
+    def test_update_last_inbound(self, recipients, smsin):
+        Recipient.objects.update(last_inbound=None)
+        Recipient.update_last_inbound()
+        calvin = Recipient.objects.get(pk=recipients['calvin'].pk)
+        assert calvin.last_inbound_id == SmsInbound.objects.filter(sender_num=str(calvin.number)).first().pk
+        assert Recipient.objects.get(pk=recipients['knox'].pk).last_inbound is None
+
+    def test_update_last_inbound_undated_last(self, recipients):
+        calvin = recipients['calvin']
+        dated = SmsInbound.objects.create(
+            sid='sms1', content='dated', time_received=timezone.now(), sender_num=str(calvin.number)
+        )
+        SmsInbound.objects.create(sid='sms2', content='undated', time_received=None, sender_num=str(calvin.number))
+        Recipient.update_last_inbound([calvin.number])
+        assert Recipient.objects.get(pk=calvin.pk).last_inbound_id == dated.pk
+
+    def test_list_api_joins_last_sms(self, recipients, smsin, users):
+        with CaptureQueriesContext(connection) as queries:
+            resp = users['c_staff'].get('/api/v2/recipients/')
+        assert resp.status_code == 200
+        calvin, = [r for r in resp.json()['results'] if r['pk'] == recipients['calvin'].pk]
+        assert calvin['last_sms']['content'] == 'archived message'
+        table = SmsInbound._meta.db_table
+        assert not [q for q in queries if q['sql'].startswith('SELECT') and 'FROM "{0}"'.format(table) in q['sql']]
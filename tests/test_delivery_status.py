@@ -0,0 +1,134 @@
+import time
+
+import pytest
+from django_redis import get_redis_connection
+from tests.test_twilio_view import TwilioRequestFactory, get_token
+
+from apostello import delivery_status
+from apostello.models import SmsOutbound
+from apostello.views import sms_status
+
+
+@pytest.fixture(autouse=True)
+def clear_queues():
+    conn = get_redis_connection('default')
+    conn.delete(delivery_status.PENDING_KEY, delivery_status.UNMATCHED_KEY, delivery_status.UNMATCHED_TIMES_KEY)
+    yield
+    conn.delete(delivery_status.PENDING_KEY, delivery_status.UNMATCHED_KEY, delivery_status.UNMATCHED_TIMES_KEY)
+
+
+@pytest.fixture
+def sms(recipients):
+    return [
+        SmsOutbound.objects.create(sid='SM{0:032d}'.format(i), content='test', recipient=recipients['calvin'])
+        for i in range(3)
+    ]
+
+
+@pytest.mark.django_db
+class TestDeliveryStatus:
+    def test_callback_updates_status(self, sms):
+        factory = TwilioRequestFactory(token=get_token())
+        request = factory.post('/sms/status/', data={'MessageSid': sms[0].sid, 'MessageStatus': 'delivered'})
+        resp = sms_status(request)
+        assert resp.status_code == 204
+        sms[0].refresh_from_db()
+        assert sms[0].status == 'delivered'
+
+    def test_unsigned_callback_rejected(self, sms):
+        factory = TwilioRequestFactory(token=get_token())
+        request = factory.post(
+            '/sms/status/',
+            data={'MessageSid': sms[0].sid, 'MessageStatus': 'delivered'},
+            HTTP_X_TWILIO_SIGNATURE='nope',
+        )
+        assert sms_status(request).status_code == 403
+
+    def test_flush_groups_by_status(self, sms, monkeypatch):
+        flushes = []
+        monkeypatch.setattr('apostello.delivery_status.async', lambda *args: flushes.append(args))
+        delivery_status.record(sms[0].sid, 'sent')
+        delivery_status.record(sms[1].sid, 'delivered')
+        delivery_status.record(sms[2].sid, 'delivered')
+        delivery_status.record(sms[0].sid, 'delivered')
+        # only the first update into the empty queue asks for a flush
+        assert len(flushes) == 1
+
+        assert delivery_status.flush() == 3
+        assert set(SmsOutbound.objects.values_list('status', flat=True)) == {'delivered'}
+        assert get_redis_connection('default').llen(delivery_status.PENDING_KEY) == 0
+
+    def test_status_before_message_logged(self, recipients, monkeypatch):
+        monkeypatch.setattr('apostello.delivery_status.async', lambda *args: None)
+        sid = 'SM' + 'a' * 32
+        delivery_status.record(sid, 'delivered')
+        assert delivery_status.flush() == 0
+
+        SmsOutbound.objects.create(sid=sid, content='test', recipient=recipients['calvin'], status='queued')
+        assert delivery_status.apply_unmatched([sid]) == 1
+        assert SmsOutbound.objects.get(sid=sid).status == 'delivered'
+        # only applied once
+        assert delivery_status.apply_unmatched([sid]) == 0
+
+    def test_never_moves_backwards(self, sms, monkeypatch):
+        monkeypatch.setattr('apostello.delivery_status.async', lambda *args: None)
+        delivery_status.record(sms[0].sid, 'delivered')
+        delivery_status.record(sms[0].sid, 'sent')
+        delivery_status.flush()
+        assert SmsOutbound.objects.get(pk=sms[0].pk).status == 'delivered'
+
+        delivery_status.record(sms[0].sid, 'queued')
+        assert delivery_status.flush() == 0
+        assert SmsOutbound.objects.get(pk=sms[0].pk).status == 'delivered'
+
+    def test_logged_while_flushing(self, recipients, monkeypatch):
+        monkeypatch.setattr('apostello.delivery_status.async', lambda *args: None)
+        sid = 'SM' + 'a' * 32
+        store = delivery_status._store_unmatched
+
+        def logged_meanwhile(conn, unmatched):
+            # the send logs its message and looks for statuses before the
+            # flush has stored this one
+            SmsOutbound.objects.create(sid=sid, content='test', recipient=recipients['calvin'], status='queued')
+            assert delivery_status.apply_unmatched([sid]) == 0
+            store(conn, unmatched)
+
+        monkeypatch.setattr('apostello.delivery_status._store_unmatched', logged_meanwhile)
+        delivery_status.record(sid, 'delivered')
+        assert delivery_status.flush() == 1
+        assert SmsOutbound.objects.get(sid=sid).status == 'delivered'
+        assert not get_redis_connection('default').hlen(delivery_status.UNMATCHED_KEY)
+
+    def test_retry_unmatched(self, recipients, monkeypatch):
+        monkeypatch.setattr('apostello.delivery_status.async', lambda *args: None)
+        old_sid, new_sid = 'SM' + 'a' * 32, 'SM' + 'b' * 32
+        delivery_status.record(old_sid, 'delivered')
+        delivery_status.record(new_sid, 'delivered')
+        delivery_status.flush()
+        conn = get_redis_connection('default')
+        conn.zadd(delivery_status.UNMATCHED_TIMES_KEY, **{old_sid: time.time() - delivery_status.UNMATCHED_TTL - 1})
+
+        SmsOutbound.objects.create(sid=new_sid, content='test', recipient=recipients['calvin'], status='queued')
+        assert delivery_status.retry_unmatched() == 1
+        assert SmsOutbound.objects.get(sid=new_sid).status == 'delivered'
+        # the old status expired, the newer one was applied
+        assert conn.hlen(delivery_status.UNMATCHED_KEY) == 0
+        assert conn.zcard(delivery_status.UNMATCHED_TIMES_KEY) == 0
+
+    def test_callback_url_passed_to_twilio(self, settings):
+        from tests.test_sending import FakeClient
+        from apostello.sending import create_message
+
+        client = FakeClient()
+        kwargs = {}
+        create = client.messages.create
+
+        def record_kwargs(**kw):
+            kwargs.update(kw)
+            kw.pop('status_callback', None)
+            return create(**kw)
+
+        client.messages.create = record_kwargs
+        settings.TWILIO_STATUS_CALLBACK_URL = 'https://example.com/sms/status/'
+        create_message(client, 'test', '+447927401749', '+447922537999')
+        assert kwargs['status_callback'] == 'https://example.com/sms/status/'
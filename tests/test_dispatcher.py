@@ -0,0 +1,106 @@
+import threading
+import time
+from datetime import timedelta
+
+import pytest
+from django.db import DatabaseError, connection
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from apostello import dispatcher, sending
+from apostello.models import QueuedSms
+
+
+@pytest.fixture(autouse=True)
+def clear_wake():
+    conn = get_redis_connection('default')
+    conn.delete(dispatcher.WAKE_KEY)
+    yield
+    conn.delete(dispatcher.WAKE_KEY)
+
+
+def queue(recipients, delay, **kwargs):
+    return QueuedSms.objects.create(
+        time_to_send=timezone.now() + delay,
+        content='test',
+        sent_by='test',
+        recipient=recipients['calvin'],
+        **kwargs
+    )
+
+
+@pytest.mark.django_db
+class TestNextDue:
+    def test_nothing_queued(self):
+        assert sending.next_due() is None
+        assert dispatcher.sleep_time() == dispatcher.MAX_SLEEP
+
+    def test_sleeps_until_due(self, recipients):
+        soon = queue(recipients, timedelta(seconds=30))
+        queue(recipients, timedelta(minutes=5))
+        queue(recipients, timedelta(seconds=5), sent=True)
+        assert sending.next_due() == soon.time_to_send
+        assert dispatcher.sleep_time(now=soon.time_to_send - timedelta(seconds=10)) == 10
+        assert dispatcher.sleep_time(now=soon.time_to_send + timedelta(seconds=10)) == 0
+
+    def test_claimed_ignored(self, recipients):
+        queue(recipients, timedelta(seconds=-5), claimed_at=timezone.now())
+        assert sending.next_due() is None
+
+    def test_wake(self):
+        dispatcher.wake()
+        dispatcher.wake()
+        assert get_redis_connection('default').llen(dispatcher.WAKE_KEY) == 1
+
+    def test_survives_errors(self, monkeypatch):
+        stop = threading.Event()
+        calls = []
+        closed = []
+
+        def dispatch_queued():
+            calls.append(1)
+            if len(calls) == 1:
+                raise DatabaseError('connection lost')
+            stop.set()
+            dispatcher.wake()
+            return 0
+
+        monkeypatch.setattr('apostello.sending.dispatch_queued', dispatch_queued)
+        monkeypatch.setattr('apostello.dispatcher.close_old_connections', lambda: closed.append(1))
+        monkeypatch.setattr('apostello.dispatcher.BACKOFF', 0)
+        dispatcher.run(stop=stop)
+        assert len(calls) == 2
+        assert len(closed) == 2
+
+
+@pytest.mark.slow
+@pytest.mark.django_db(transaction=True)
+def test_sends_on_time(recipients, monkeypatch):
+    sent = []
+
+    def dispatch_queued():
+        pks = sending.claim_queued(10)
+        sent.extend(pks)
+        return len(pks)
+
+    monkeypatch.setattr('apostello.sending.dispatch_queued', dispatch_queued)
+    stop = threading.Event()
+
+    def run():
+        dispatcher.run(stop=stop)
+        connection.close()
+
+    worker = threading.Thread(target=run)
+    worker.start()
+    try:
+        # scheduling wakes the sleeping dispatcher
+        time.sleep(0.5)
+        sms = queue(recipients, timedelta(seconds=1))
+        deadline = time.monotonic() + 5
+        while not sent and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert sent == [sms.pk]
+    finally:
+        stop.set()
+        dispatcher.wake()
+        worker.join()
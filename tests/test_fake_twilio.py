@@ -0,0 +1,54 @@
+import pytest
+from twilio.base.exceptions import TwilioRestException
+
+from apostello import sending
+from apostello.fake_twilio import FakeClient
+from apostello.models import SmsInbound, SmsOutbound
+from apostello.twilio import get_twilio_client
+
+
+@pytest.fixture
+def fake_backend(settings):
+    settings.SMS_BACKEND = 'apostello.fake_twilio.FakeClient'
+    return get_twilio_client()
+
+
+@pytest.mark.django_db
+class TestFakeTwilio:
+    def test_backend_setting(self, fake_backend):
+        assert isinstance(fake_backend, FakeClient)
+        assert get_twilio_client() is fake_backend
+
+    def test_send_recorded(self, fake_backend, groups):
+        sending.send_group('Hi %name%', 'Test Group', 'test')
+        assert sorted(m.body for m in fake_backend.messages.sent) == ['Hi Johannes', 'Hi John']
+        sids = {m.sid for m in fake_backend.messages.sent}
+        assert set(SmsOutbound.objects.values_list('sid', flat=True)) == sids
+
+    def test_error_rate(self, fake_backend, settings):
+        settings.FAKE_SMS_ERROR_RATE = 1
+        with pytest.raises(TwilioRestException):
+            fake_backend.messages.create(body='test', to='+447927401749', from_='+447922537999')
+
+    def test_rate_limit(self, fake_backend, settings):
+        settings.FAKE_SMS_RATE_LIMIT = 2
+        for _ in range(2):
+            fake_backend.messages.create(body='test', to='+447927401749', from_='+447922537999')
+        with pytest.raises(TwilioRestException) as e:
+            fake_backend.messages.create(body='test', to='+447927401749', from_='+447922537999')
+        assert e.value.status == 429
+
+    def test_receive_replays_webhook(self, fake_backend, recipients, keywords):
+        resp = fake_backend.receive('+447927401749', 'test')
+        assert resp.status_code == 200
+        msg, = [m for m in fake_backend.messages.sent if m.direction == 'inbound']
+        assert SmsInbound.objects.get(sid=msg.sid).content == 'test'
+
+    def test_deliver_callback(self, fake_backend, recipients):
+        calvin = recipients['calvin']
+        people = [{'pk': calvin.pk, 'first_name': 'John', 'number': str(calvin.number)}]
+        sms, _ = sending.send_messages(people, 'test', 'test')
+        SmsOutbound.objects.bulk_create(sms)
+        sid = fake_backend.messages.sent[-1].sid
+        assert fake_backend.deliver(sid).status_code == 204
+        assert SmsOutbound.objects.get(sid=sid).status == 'delivered'
@@ -1,9 +1,12 @@
+import threading
+import time
 import types
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 import pytest
 from django.conf import settings
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from tests.conftest import twilio_vcr
 
 from apostello import logs, models
@@ -13,16 +16,54 @@ today = timezone.localdate()
 
 
 class MockMsg:
-    def __init__(self, from_):
-        self.sid = 'a' * 34
+    def __init__(self, from_, sid='a' * 34, date=None):
+        self.sid = sid
         self.body = 'test message'
         self.from_ = from_
         self.to = settings.to = '447922537999'
-        self.date_created = timezone.now()
-        self.date_sent = timezone.now()
+        self.date_created = date or timezone.now()
+        self.date_sent = date or timezone.now()
         self.status = 'unknown'
 
 
+class MockMessageContext:
+    def __init__(self, msg):
+        self.msg = msg
+
+    def fetch(self):
+        return self.msg
+
+
+class MockMessages:
+    def __init__(self, msgs):
+        self.msgs = msgs
+        self.requests = []
+
+    def __call__(self, sid):
+        return MockMessageContext([m for m in self.msgs if m.sid == sid][0])
+
+    def stream(self, to=None, from_=None, date_sent_after=None, date_sent_before=None):
+        self.requests.append({
+            'to': to,
+            'from_': from_,
+            'date_sent_after': date_sent_after,
+            'date_sent_before': date_sent_before,
+        })
+        for m in self.msgs:
+            if date_sent_after is not None and m.date_sent.date() < date_sent_after:
+                continue
+            if date_sent_before is not None and m.date_sent.date() > date_sent_before:
+                continue
+            yield m
+
+
+class MockClient:
+    """Stand in for twilio.rest.Client."""
+
+    def __init__(self, msgs):
+        self.messages = MockMessages(msgs)
+
+
 @pytest.mark.django_db
 class TestImportLogs:
     """
@@ -47,21 +88,41 @@ class TestExpiry:
     Test log imports with expiry date.
     """
 
-    @twilio_vcr
-    def test_import_incoming_expiry_date(self):
+    @pytest.fixture
+    def client(self, monkeypatch):
+        msgs = [
+            MockMsg('447922537999', sid='a' * 34, date=timezone.now() - timedelta(days=30)),
+            MockMsg('447922537999', sid='b' * 34),
+        ]
+        client = MockClient(msgs)
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: client)
+        return client
+
+    def test_import_incoming_expiry_date(self, client):
         config = SiteConfiguration.get_solo()
         config.sms_expiration_date = today
         config.save()
         logs.check_incoming_log()
         assert models.SmsInbound.objects.filter(time_received__lt=today).count() == 0
+        assert models.SmsInbound.objects.count() == 1
+        assert all(r['date_sent_after'] == today for r in client.messages.requests)
 
-    @twilio_vcr
-    def test_import_outgoing_expiry_date(self):
+    def test_import_outgoing_expiry_date(self, client):
         config = SiteConfiguration.get_solo()
         config.sms_expiration_date = today
         config.save()
         logs.check_outgoing_log()
         assert models.SmsOutbound.objects.filter(time_sent__lt=today).count() == 0
+        assert models.SmsOutbound.objects.count() == 1
+        assert all(r['date_sent_after'] == today for r in client.messages.requests)
+
+    def test_expiry_date_limits_cursor(self, client):
+        config = SiteConfiguration.get_solo()
+        config.sms_expiration_date = today
+        config.save()
+        models.LogSyncCursor.objects.create(direction='in', last_date=timezone.now() - timedelta(days=60))
+        logs.check_incoming_log()
+        assert all(r['date_sent_after'] == today for r in client.messages.requests)
 
     @twilio_vcr
     def test_cleanup_expiry_date(self):
@@ -80,23 +141,23 @@ class TestExpiry:
         logs.cleanup_expired_sms()
         assert models.SmsInbound.objects.count() + models.SmsOutbound.objects.count() == 0
 
-    @twilio_vcr
-    def test_import_incoming_rolling(self):
+    def test_import_incoming_rolling(self, client):
         config = SiteConfiguration.get_solo()
         config.sms_expiration_date = None
         config.sms_rolling_expiration_days = 0
         config.save()
         logs.check_incoming_log()
         assert models.SmsInbound.objects.filter(time_received__lt=today).count() == 0
+        assert models.SmsInbound.objects.count() == 1
 
-    @twilio_vcr
-    def test_import_outgoing_rolling(self):
+    def test_import_outgoing_rolling(self, client):
         config = SiteConfiguration.get_solo()
         config.sms_expiration_date = None
         config.sms_rolling_expiration_days = 0
         config.save()
         logs.check_outgoing_log()
         assert models.SmsOutbound.objects.filter(time_sent__lt=today).count() == 0
+        assert models.SmsOutbound.objects.count() == 1
 
     @twilio_vcr
     def test_cleanup_rolling(self):
@@ -143,6 +204,25 @@ class TestExpiry:
         logs.cleanup_expired_sms()
         assert models.SmsInbound.objects.count() == 0  # cleanup should remove sms
 
+    def test_cleanup_in_batches(self, settings, monkeypatch):
+        settings.SMS_CLEANUP_BATCH_SIZE = 2
+        pauses = []
+        monkeypatch.setattr('apostello.logs.time.sleep', pauses.append)
+        config = SiteConfiguration.get_solo()
+        config.sms_rolling_expiration_days = None
+        config.sms_expiration_date = today
+        config.save()
+        for i in range(5):
+            models.SmsInbound.objects.create(
+                content='old', time_received=timezone.now() - timedelta(days=2), sid='old{0}'.format(i)
+            )
+        models.SmsInbound.objects.create(content='new', time_received=timezone.now(), sid='new')
+
+        assert logs.cleanup_expired_sms() == 5
+        assert list(models.SmsInbound.objects.values_list('sid', flat=True)) == ['new']
+        # full batches are followed by a pause, the final partial one is not
+        assert len(pauses) == 2
+
 
 @pytest.mark.django_db
 class TestSmsHandlers:
@@ -159,6 +239,15 @@ class TestSmsHandlers:
         cnp = logs.handle_incoming_sms(msg)
         assert models.SmsInbound.objects.count() == 1
 
+    def test_handle_incoming_sms_sets_last_sms(self):
+        config = SiteConfiguration.get_solo()
+        config.sms_expiration_date = None
+        config.save()
+
+        logs.handle_incoming_sms(MockMsg('+447927401111'))
+        sender = models.Recipient.objects.get(number='+447927401111')
+        assert sender.last_sms['content'] == 'test message'
+
     def test_handle_outgoing_sms(self):
         config = SiteConfiguration.get_solo()
         config.sms_expiration_date = None
@@ -173,6 +262,213 @@ class TestSmsHandlers:
         assert models.SmsOutbound.objects.count() == 1
 
 
+@pytest.mark.django_db
+class TestIncrementalSync:
+    @pytest.fixture(autouse=True)
+    def no_expiry(self):
+        config = SiteConfiguration.get_solo()
+        config.sms_expiration_date = None
+        config.sms_rolling_expiration_days = None
+        config.save()
+
+    def test_cursor_moves_forward(self, monkeypatch):
+        old = MockMsg('447922537999', sid='a' * 34, date=timezone.now() - timedelta(days=10))
+        new = MockMsg('447922537999', sid='b' * 34, date=timezone.now() - timedelta(days=2))
+        client = MockClient([new, old])
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: client)
+
+        logs.check_incoming_log()
+        cursor = models.LogSyncCursor.objects.get(direction='in')
+        assert cursor.last_sid == new.sid
+        assert cursor.last_date == new.date_created
+        assert client.messages.requests[0]['date_sent_after'] is None
+        assert models.SmsInbound.objects.count() == 2
+
+        logs.check_incoming_log()
+        since = client.messages.requests[1]['date_sent_after']
+        assert since == (new.date_created - logs.LOG_SYNC_OVERLAP).astimezone(timezone.utc).date()
+
+    def test_full_ignores_cursor(self, monkeypatch):
+        client = MockClient([MockMsg('447922537999')])
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: client)
+        logs.check_outgoing_log()
+        logs.check_outgoing_log(full=True)
+        assert client.messages.requests[1]['date_sent_after'] is None
+
+    def test_management_command_since(self, monkeypatch):
+        from django.core.management import call_command
+        client = MockClient([MockMsg('447922537999')])
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: client)
+        call_command('import_incoming_sms', '--since', '2018-01-31')
+        assert min(r['date_sent_after'] for r in client.messages.requests) == datetime(2018, 1, 31).date()
+        call_command('import_outgoing_sms', '--full')
+        assert client.messages.requests[-1]['date_sent_after'] is None
+
+
+@pytest.mark.django_db
+class TestBulkImport:
+    @pytest.fixture(autouse=True)
+    def no_expiry(self):
+        config = SiteConfiguration.get_solo()
+        config.sms_expiration_date = None
+        config.sms_rolling_expiration_days = None
+        config.save()
+
+    def test_incoming_page(self, recipients, groups):
+        config = SiteConfiguration.get_solo()
+        config.auto_add_new_groups.add(groups['empty_group'])
+        msgs = [MockMsg('+4477{0:08d}'.format(i), sid='{0:034d}'.format(i)) for i in range(20)]
+        msgs.append(MockMsg(str(recipients['calvin'].number), sid='c' * 34))
+        # duplicate sids within a page are only imported once
+        msgs.append(msgs[0])
+
+        assert logs.import_incoming_page(msgs) == 21
+        assert models.SmsInbound.objects.count() == 21
+        assert models.SmsInbound.objects.get(sid='c' * 34).sender_name == str(recipients['calvin'])
+        new_contacts = models.Recipient.objects.filter(first_name='Unknown')
+        assert new_contacts.count() == 20
+        assert groups['empty_group'].recipient_set.count() == 20
+        # already imported
+        assert logs.import_incoming_page(msgs) == 0
+
+    def test_outgoing_page(self, recipients):
+        msgs = []
+        for i in range(5):
+            msg = MockMsg('447922537999', sid='{0:034d}'.format(i))
+            msg.to = str(recipients['calvin'].number)
+            msgs.append(msg)
+        msgs[0].date_sent = None
+
+        assert logs.import_outgoing_page(msgs) == 5
+        assert models.SmsOutbound.objects.filter(recipient=recipients['calvin']).count() == 5
+        assert models.SmsOutbound.objects.get(sid=msgs[0].sid).time_sent == msgs[0].date_created
+
+    def test_falls_back_on_collision(self, monkeypatch):
+        from django.db import IntegrityError
+
+        def collide(*args, **kwargs):
+            raise IntegrityError
+
+        msg = MockMsg('447922537999')
+        monkeypatch.setattr(models.SmsInbound.objects, 'bulk_create', collide)
+        assert logs.import_incoming_page([msg]) == 1
+        assert models.SmsInbound.objects.filter(sid=msg.sid).exists()
+
+    def test_check_log_batches(self, monkeypatch):
+        msgs = [MockMsg('447922537999', sid='{0:034d}'.format(i)) for i in range(7)]
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: MockClient(msgs))
+        monkeypatch.setattr('apostello.logs.IMPORT_BATCH_SIZE', 3)
+        pages = []
+        import_page = logs.import_incoming_page
+
+        def record_page(page, **kwargs):
+            pages.append(len(page))
+            return import_page(page, **kwargs)
+
+        monkeypatch.setattr('apostello.logs.import_incoming_page', record_page)
+
+        logs.check_incoming_log()
+        assert pages == [3, 3, 1]
+        assert models.SmsInbound.objects.count() == 7
+
+
+class SlowMessages(MockMessages):
+    """Twilio stand in that takes a while to answer each request."""
+
+    def __init__(self, msgs, latency=0.05):
+        super().__init__(msgs)
+        self.latency = latency
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def stream(self, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            yield from super().stream(**kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@pytest.mark.django_db
+class TestParallelFetch:
+    def test_windows_do_not_overlap(self, monkeypatch):
+        monkeypatch.setattr('apostello.logs.LOG_FETCH_WINDOW_DAYS', 7)
+        start = datetime(2018, 1, 1).date()
+        windows = logs.fetch_windows(start, start + timedelta(days=20))
+        assert windows == [
+            (start, start + timedelta(days=6)),
+            (start + timedelta(days=7), start + timedelta(days=13)),
+            (start + timedelta(days=14), None),
+        ]
+        assert logs.fetch_windows(start, start) == [(start, None)]
+
+    def test_fetches_windows_concurrently(self, monkeypatch):
+        now = timezone.now()
+        msgs = [MockMsg('447922537999', sid='{0:034d}'.format(i), date=now - timedelta(days=i)) for i in range(60)]
+        client = MockClient(msgs)
+        client.messages = SlowMessages(msgs)
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: client)
+        monkeypatch.setattr('apostello.logs.IMPORT_BATCH_SIZE', 5)
+        monkeypatch.setattr('apostello.logs.LOG_FETCH_QUEUE_SIZE', 2)
+
+        pages = list(logs.fetch_pages('in', since=now - timedelta(days=59)))
+        sids = [m.sid for page in pages for m in page]
+        assert sorted(sids) == sorted(m.sid for m in msgs)
+        assert all(len(page) <= 5 for page in pages)
+        assert client.messages.max_active > 1
+        assert client.messages.max_active <= logs.LOG_FETCH_WORKERS
+
+    def test_errors_reach_caller(self, monkeypatch):
+        class BrokenMessages(MockMessages):
+            def stream(self, **kwargs):
+                raise RuntimeError('twilio is down')
+                yield
+
+        client = MockClient([])
+        client.messages = BrokenMessages([])
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: client)
+        with pytest.raises(RuntimeError):
+            list(logs.fetch_pages('out', since=timezone.now() - timedelta(days=30)))
+
+    def test_consumer_can_stop_early(self, monkeypatch):
+        now = timezone.now()
+        msgs = [MockMsg('447922537999', sid='{0:034d}'.format(i), date=now - timedelta(days=i)) for i in range(60)]
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: MockClient(msgs))
+        monkeypatch.setattr('apostello.logs.IMPORT_BATCH_SIZE', 1)
+        monkeypatch.setattr('apostello.logs.LOG_FETCH_QUEUE_SIZE', 1)
+        pages = logs.fetch_pages('in', since=now - timedelta(days=59))
+        next(pages)
+        # closing must not leave fetchers blocked on the full queue
+        pages.close()
+
+
+def test_batches():
+    assert list(logs.batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(logs.batches([], 2)) == []
+
+
+@pytest.mark.django_db
+class TestCheckIncomingSms:
+    def test_fetches_single_sid(self, monkeypatch):
+        config = SiteConfiguration.get_solo()
+        config.sms_expiration_date = None
+        config.save()
+        msg = MockMsg('447922537999')
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: MockClient([msg]))
+        logs.check_incoming_sms(msg.sid)
+        assert models.SmsInbound.objects.get(sid=msg.sid).content == msg.body
+
+    @twilio_vcr
+    def test_missing_sid(self):
+        logs.check_incoming_sms('thisisreallyauuid')
+        assert models.SmsInbound.objects.count() == 0
+
+
 @pytest.mark.django_db
 class TestFetchingClients:
     @twilio_vcr
@@ -190,3 +486,30 @@ class TestFetchingClients:
     @twilio_vcr
     def test_fetch_all_bad(self):
         assert isinstance(logs.fetch_generator('nope'), list)
+
+
+@pytest.mark.django_db
+class TestOutgoingLogCheck:
+    def test_single_pending_check(self):
+        assert logs.next_outgoing_log_check() is None
+        first_run = logs.schedule_outgoing_log_check()
+        second_run = logs.schedule_outgoing_log_check()
+        assert logs.pending_outgoing_log_checks().count() == 1
+        assert second_run >= first_run
+        assert logs.next_outgoing_log_check() == second_run
+
+    def test_check_not_delayed_past_deadline(self):
+        from django.core.cache import cache
+        logs.schedule_outgoing_log_check()
+        deadline = timezone.now() + timedelta(seconds=5)
+        cache.set(logs.OUTGOING_LOG_CHECK_DEADLINE_KEY, deadline, 60)
+        check = logs.pending_outgoing_log_checks().first()
+        check.next_run = timezone.now()
+        check.save()
+        assert logs.schedule_outgoing_log_check() == deadline
+
+    def test_api_reports_next_check(self, users):
+        next_run = logs.schedule_outgoing_log_check()
+        resp = users['c_staff'].get('/api/v2/logs/sync/')
+        assert resp.status_code == 200
+        assert parse_datetime(resp.json()['next_outgoing_log_check']) == next_run
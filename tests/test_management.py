@@ -13,6 +13,35 @@ class TestManagementCommands():
         """Test update sms name fields command."""
         call_command('update_sms_name_fields')
 
+    def test_update_sms_name_fields_batches(self, recipients, smsin):
+        """Test names are rewritten across several batches."""
+        from io import StringIO
+        from apostello.models import Recipient, SmsInbound
+        Recipient.objects.filter(pk=recipients['calvin'].pk).update(first_name='Jean')
+        out = StringIO()
+        call_command('update_sms_name_fields', '--batch-size', '2', stdout=out)
+        calvin_sms = SmsInbound.objects.filter(sender_num=str(recipients['calvin'].number))
+        assert set(calvin_sms.values_list('sender_name', flat=True)) == {'Jean Calvin'}
+        num_contacts = Recipient.objects.count()
+        assert 'Updated {0}/{0} contacts'.format(num_contacts) in out.getvalue()
+
+    def test_update_sms_name_fields_default_batch(self):
+        """Test a default sized batch stays within SQLite's parameter limit."""
+        from django.utils import timezone
+        from apostello.models import Recipient, SmsInbound
+        numbers = ['+4479274{0:05d}'.format(i) for i in range(400)]
+        Recipient.objects.bulk_create(
+            Recipient(first_name='Contact', last_name=str(i), number=num) for i, num in enumerate(numbers)
+        )
+        SmsInbound.objects.bulk_create(
+            SmsInbound(
+                sid='SM{0:032d}'.format(i), content='hi', time_received=timezone.now(), sender_name='', sender_num=num
+            ) for i, num in enumerate(numbers)
+        )
+        call_command('update_sms_name_fields')
+        assert SmsInbound.objects.filter(sender_name='').count() == 0
+        assert SmsInbound.objects.get(sender_num=numbers[-1]).sender_name == 'Contact 399'
+
     @twilio_vcr
     def test_import_in(self):
         """Test import incoming sms command."""
@@ -26,9 +55,9 @@ class TestManagementCommands():
     def test_setup_scheduled_tasks(self):
         """Test setup of perdiodic tasks and ensure function is idempotent."""
         call_command('setup_periodic_tasks')
-        assert Schedule.objects.all().count() == 6
+        assert Schedule.objects.all().count() == 9
         call_command('setup_periodic_tasks')
-        assert Schedule.objects.all().count() == 6
+        assert Schedule.objects.all().count() == 9
 
     def test_write_elm_urls(self):
         """Test Elm Urls are up to date."""
@@ -0,0 +1,81 @@
+from collections import Counter
+
+import pytest
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from tests.test_logs import MockClient
+from tests.test_sending import FakeClient
+
+from apostello import logs, number_pool, sending
+from apostello.validators import not_twilio_num
+from site_config.models import SendingNumber, SiteConfiguration
+
+POOL = ['+447922537999', '+447922537001', '+447922537002', '+447922537003']
+
+
+@pytest.fixture
+def pool():
+    cache.delete('sending_numbers')
+    config = SiteConfiguration.get_solo()
+    config.twilio_from_num = POOL[0]
+    config.save()
+    for number in POOL[1:]:
+        SendingNumber.objects.create(number=number)
+    yield POOL
+    cache.delete('sending_numbers')
+
+
+@pytest.mark.django_db
+class TestNumberPool:
+    def test_sending_numbers(self, pool):
+        assert number_pool.sending_numbers() == pool
+        SendingNumber.objects.filter(number=pool[1]).update(is_active=False)
+        cache.delete('sending_numbers')
+        assert pool[1] not in number_pool.sending_numbers()
+        assert pool[1] in number_pool.our_numbers()
+
+    def test_cache_cleared_by_queryset_delete(self, pool):
+        assert number_pool.sending_numbers() == pool
+        SendingNumber.objects.filter(number__in=pool[2:]).delete()
+        assert number_pool.sending_numbers() == pool[:2]
+
+    def test_our_numbers_cached(self, pool, django_assert_num_queries):
+        number_pool.our_numbers()
+        with django_assert_num_queries(0):
+            assert number_pool.our_numbers() == pool
+            not_twilio_num('+447927401749')
+
+    def test_assignment_is_sticky(self, pool):
+        contacts = ['+4479274{0:05d}'.format(i) for i in range(1000)]
+        before = {c: number_pool.number_for(c, pool) for c in contacts}
+        assert before == {c: number_pool.number_for(c, pool) for c in contacts}
+        # roughly even spread
+        assert min(Counter(before.values()).values()) > 150
+
+        # removing a number only moves the contacts it was sending to
+        after = {c: number_pool.number_for(c, pool[:-1]) for c in contacts}
+        moved = [c for c in contacts if before[c] != after[c]]
+        assert all(before[c] == pool[-1] for c in moved)
+
+    def test_send_spread_across_pool(self, pool, recipients, monkeypatch):
+        client = FakeClient()
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        people = [
+            {'pk': recipients['calvin'].pk, 'first_name': 'John', 'number': '+4479274{0:05d}'.format(i)}
+            for i in range(40)
+        ]
+        sending.send_messages(people, 'Hi', 'test')
+        assert {m['from_'] for m in client.messages.sent} == set(pool)
+        for msg in client.messages.sent:
+            assert msg['from_'] == number_pool.number_for(msg['to'], pool)
+
+    def test_cannot_add_pool_number_as_contact(self, pool):
+        with pytest.raises(ValidationError):
+            not_twilio_num(pool[2])
+        not_twilio_num('+447927401749')
+
+    def test_log_import_covers_pool(self, pool, monkeypatch):
+        client = MockClient([])
+        monkeypatch.setattr('apostello.logs.get_twilio_client', lambda: client)
+        list(logs.fetch_generator('in'))
+        assert [r['to'] for r in client.messages.requests] == pool
@@ -0,0 +1,59 @@
+import pytest
+from django_redis import get_redis_connection
+
+from apostello import sending
+from apostello.rate_limit import TokenBucket, sends_within
+
+
+@pytest.fixture
+def bucket():
+    bucket = TokenBucket('+447922537999', rate=10, burst=2)
+    get_redis_connection('default').delete(bucket.key)
+    yield bucket
+    get_redis_connection('default').delete(bucket.key)
+
+
+class TestTokenBucket:
+    def test_burst_then_rate(self, bucket):
+        waits = [bucket.reserve(now=1000.0) for _ in range(5)]
+        assert waits == pytest.approx([0, 0, 0.1, 0.2, 0.3])
+
+    def test_refills(self, bucket):
+        for _ in range(3):
+            bucket.reserve(now=1000.0)
+        assert bucket.reserve(now=1010.0) == 0
+
+    def test_shared_between_instances(self, bucket):
+        other = TokenBucket('+447922537999', rate=10, burst=2)
+        bucket.reserve(now=1000.0)
+        bucket.reserve(now=1000.0)
+        assert other.reserve(now=1000.0) == pytest.approx(0.1)
+
+    def test_disabled(self):
+        assert TokenBucket('+447922537999', rate=0).reserve() == 0
+
+
+def test_sends_within():
+    assert sends_within(20, rate=1, burst=1) == 21
+    assert sends_within(20, rate=0.5, burst=5) == 15
+    assert sends_within(20, rate=0, burst=1) is None
+
+
+@pytest.mark.django_db
+class TestChunkSize:
+    def test_sized_by_rate(self, settings):
+        settings.SMS_SEND_RATE = 1
+        settings.SMS_SEND_BURST = 1
+        settings.SMS_SEND_CHUNK_SECONDS = 20
+        assert sending.chunk_size() == 21
+
+    def test_within_task_timeout(self, settings):
+        settings.SMS_SEND_RATE = 1
+        settings.SMS_SEND_BURST = 1
+        settings.SMS_SEND_CHUNK_SECONDS = 600
+        settings.Q_CLUSTER = dict(settings.Q_CLUSTER, timeout=120)
+        assert sending.chunk_size() == 120 - sending.TASK_TIMEOUT_MARGIN + 1
+
+    def test_unlimited(self, settings):
+        settings.SMS_SEND_RATE = 0
+        assert sending.chunk_size() == settings.SMS_SEND_CHUNK_SIZE
@@ -0,0 +1,76 @@
+import pytest
+
+from apostello import segments
+from apostello.models import Recipient
+
+
+class TestSegments:
+    @pytest.mark.parametrize(
+        'text,num_segments', [
+            ('a' * 160, 1),
+            ('a' * 161, 2),
+            ('a' * 306, 2),
+            ('a' * 307, 3),
+            ('[' * 80, 1),
+            ('[' * 81, 2),
+            ('ä' * 70, 1),
+            ('ĉ' * 70, 1),
+            ('ĉ' * 71, 2),
+            ('ĉ' * 134, 2),
+            ('ĉ' * 135, 3),
+            ('😀' * 35, 1),
+            ('😀' * 36, 2),
+        ]
+    )
+    def test_count_segments(self, text, num_segments):
+        assert segments.count_segments(text) == num_segments
+
+    def test_total_matches_personalising_each(self):
+        msg = 'Hi %name%, ' + 'a' * 150
+        names = {'John': 3, 'Ĉarles': 2, 'Bob' * 10: 1}
+        expected = sum(
+            segments.count_segments(msg.replace('%name%', name)) * n for name, n in names.items()
+        )
+        assert segments.total_segments(msg, names) == expected
+        assert expected == 3 * 1 + 2 * 3 + 1 * 2
+
+    def test_total_without_name(self):
+        assert segments.total_segments('a' * 200, {'John': 2, 'Joe': 3}) == 10
+
+
+@pytest.mark.django_db
+class TestCost:
+    def test_name_counts_single_query(self, recipients, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            counts = segments.first_name_counts(Recipient.objects.all())
+        assert counts['John'] == 4
+
+    def test_long_names_cost_more(self, recipients):
+        msg = '%name% ' + 'a' * 155
+        short = Recipient.message_cost(Recipient.objects.filter(pk=recipients['calvin'].pk), msg)
+        long_ = Recipient.message_cost(Recipient.objects.filter(pk=recipients['house_lamp'].pk), msg)
+        assert short < long_
+
+    def test_preview_api(self, groups, users):
+        resp = users['c_staff'].get(
+            '/api/v2/actions/sms/cost/', {
+                'content': 'Hi %name%',
+                'recipient_group': groups['test_group'].pk
+            }
+        )
+        assert resp.status_code == 200
+        data = resp.json()
+        assert data['recipients'] == 2
+        assert data['segments'] == 2
+        assert 'cost' in data
+
+    def test_preview_api_recipients(self, recipients, users):
+        resp = users['c_staff'].get(
+            '/api/v2/actions/sms/cost/', {
+                'content': 'ĉ' * 100,
+                'recipients': [recipients['calvin'].pk, recipients['knox'].pk]
+            }
+        )
+        # archived contacts are not sent to
+        assert resp.json()['recipients'] == 1
+        assert resp.json()['segments'] == 2
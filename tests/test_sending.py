@@ -0,0 +1,394 @@
+import threading
+import time
+import types
+from datetime import timedelta
+
+import pytest
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from twilio.base.exceptions import TwilioRestException
+
+from apostello import sending
+from apostello.tasks import group_send_message_task
+from apostello.models import QueuedSms, Recipient, SendJob, SendJobRecipient, SmsOutbound
+
+
+class FakeMessages:
+    def __init__(self, fail=None, rate_limited=0):
+        self.sent = []
+        self.fail = fail or {}
+        self.rate_limited = rate_limited
+
+    def create(self, body=None, to=None, from_=None):
+        if to in self.fail:
+            raise TwilioRestException(400, 'uri', msg='fail', code=self.fail[to])
+        if self.rate_limited:
+            self.rate_limited -= 1
+            raise TwilioRestException(429, 'uri', msg='Too Many Requests', code=20429)
+        self.sent.append({'body': body, 'to': to, 'from_': from_})
+        return types.SimpleNamespace(sid='SM{0:032d}'.format(len(self.sent)), status='queued')
+
+
+class FakeClient:
+    def __init__(self, fail=None, rate_limited=0):
+        self.messages = FakeMessages(fail, rate_limited)
+
+
+class SlowMessages(FakeMessages):
+    """Fake Twilio endpoint with network latency."""
+
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def create(self, body=None, to=None, from_=None):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            with self.lock:
+                return super().create(body=body, to=to, from_=from_)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@pytest.mark.django_db
+class TestGroupSend:
+    def test_group_recipients(self, groups, recipients):
+        people = sending.group_recipients(groups['test_group'])
+        assert sorted(p['pk'] for p in people) == sorted(
+            [recipients['calvin'].pk, recipients['house_lamp'].pk]
+        )
+        groups['test_group'].recipient_set.add(recipients['wesley'], recipients['knox'])
+        # blocking and archived contacts are left out
+        assert len(sending.group_recipients(groups['test_group'])) == 2
+
+    def test_send_group_in_chunks(self, groups, recipients, settings, monkeypatch):
+        settings.SMS_SEND_CHUNK_SIZE = 1
+        client = FakeClient()
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        chunks = []
+        send_messages = sending.send_messages
+
+        def record_chunk(recipients, *args, **kwargs):
+            chunks.append(len(recipients))
+            return send_messages(recipients, *args, **kwargs)
+
+        monkeypatch.setattr('apostello.sending.send_messages', record_chunk)
+        job = sending.send_group('Hi %name%', 'Test Group', 'test')
+
+        assert chunks == [1, 1]
+        assert sorted(m['body'] for m in client.messages.sent) == ['Hi Johannes', 'Hi John']
+        assert SmsOutbound.objects.filter(recipient_group=groups['test_group'], send_job=job).count() == 2
+        job.refresh_from_db()
+        assert job.status == SendJob.COMPLETE
+        assert (job.total, job.sent, job.failed) == (2, 2, 0)
+        assert job.progress == 1.0
+
+    def test_blacklisted_number(self, recipients, monkeypatch):
+        calvin = recipients['calvin']
+        client = FakeClient(fail={str(calvin.number): sending.BLACKLISTED_ERROR_CODE})
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        people = [{'pk': calvin.pk, 'first_name': calvin.first_name, 'number': str(calvin.number)}]
+        assert sending.send_messages(people, 'test', 'test') == ([], 1)
+        assert Recipient.objects.get(pk=calvin.pk).is_blocking
+
+
+@pytest.mark.django_db
+class TestSendJob:
+    @pytest.fixture
+    def job(self, groups, recipients):
+        group = groups['test_group']
+        group.recipient_set.add(recipients['john_owen'])
+        return SendJob.objects.create(
+            content='test', sent_by='test', recipient_group=group, total=3, status=SendJob.SENDING
+        )
+
+    def test_resumes_from_checkpoint(self, job, recipients, monkeypatch):
+        client = FakeClient()
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        first, second, third = sending.group_recipients(job.recipient_group)
+        # the worker died while sending to the second recipient, before
+        # moving the checkpoint past them
+        SendJob.objects.filter(pk=job.pk).update(checkpoint=first['pk'], sent=1)
+        SendJobRecipient.objects.create(send_job=job, recipient_id=second['pk'])
+
+        sending.send_job_chunk(job.pk)
+        assert [m['to'] for m in client.messages.sent] == [third['number']]
+        job.refresh_from_db()
+        assert job.status == SendJob.COMPLETE
+        assert job.checkpoint == third['pk']
+        assert job.lease_owner == ''
+
+    def test_claimed_before_sending(self, job, monkeypatch):
+        client = FakeClient(fail={'+15005550004': 30003})
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        monkeypatch.setattr('apostello.sending.async', lambda *args: None)
+        claims = []
+
+        def create(**kwargs):
+            claims.append(SendJobRecipient.objects.filter(send_job=job).count())
+            return FakeMessages.create(client.messages, **kwargs)
+
+        monkeypatch.setattr(client.messages, 'create', create)
+        sending.send_job_chunk(job.pk)
+        # the whole chunk is claimed before anything is sent
+        assert claims == [3, 3, 3]
+        assert sorted(SendJobRecipient.objects.values_list('status', flat=True)) == [
+            SendJobRecipient.FAILED, SendJobRecipient.SENT, SendJobRecipient.SENT
+        ]
+        job.refresh_from_db()
+        assert (job.sent, job.failed) == (2, 1)
+
+    def test_chunk_logged_with_one_insert(self, job, monkeypatch):
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: FakeClient())
+        monkeypatch.setattr('apostello.sending.async', lambda *args: None)
+        with CaptureQueriesContext(connection) as queries:
+            sending.send_job_chunk(job.pk)
+        inserts = [q['sql'] for q in queries if q['sql'].startswith('INSERT')]
+        assert len(inserts) == 2
+        assert len([sql for sql in inserts if SmsOutbound._meta.db_table in sql]) == 1
+        assert SmsOutbound.objects.filter(send_job=job).count() == 3
+
+    def test_leased_job_not_sent(self, job, monkeypatch):
+        client = FakeClient()
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        SendJob.objects.filter(pk=job.pk).update(
+            lease_owner='other', lease_expires=timezone.now() + timedelta(minutes=1)
+        )
+        sending.send_job_chunk(job.pk)
+        sending.send_job_chunk(job.pk, 'mine')
+        assert client.messages.sent == []
+
+        sending.send_job_chunk(job.pk, 'other')
+        assert len(client.messages.sent) == 3
+
+    def test_resume_stalled_jobs(self, job, monkeypatch):
+        resumed = []
+        monkeypatch.setattr('apostello.sending.async', lambda *args: resumed.append(args))
+        SendJob.objects.filter(pk=job.pk).update(
+            lease_owner='dead', lease_expires=timezone.now() + timedelta(minutes=1)
+        )
+        sending.resume_send_jobs()
+        assert resumed == []
+
+        SendJob.objects.filter(pk=job.pk).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        sending.resume_send_jobs()
+        (task, job_pk, token), = resumed
+        assert (task, job_pk) == ('apostello.tasks.send_job_chunk_task', job.pk)
+        assert SendJob.objects.get(pk=job.pk).lease_owner == token
+        # the job has a new lease now
+        sending.resume_send_jobs()
+        assert len(resumed) == 1
+
+    def test_api_progress(self, job, users):
+        resp = users['c_staff'].get('/api/v2/send_jobs/')
+        assert resp.status_code == 200
+        data = resp.json()['results'][0]
+        assert data['pk'] == job.pk
+        assert data['total'] == 3
+        assert data['progress'] == 0.0
+
+
+class TestCreateMessage:
+    def test_retries_when_rate_limited(self, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr('apostello.sending.time.sleep', sleeps.append)
+        client = FakeClient(rate_limited=2)
+        sending.create_message(client, 'test', '+447927401749', '+447922537999')
+        assert len(client.messages.sent) == 1
+        assert len(sleeps) == 2
+
+    def test_gives_up(self, monkeypatch):
+        monkeypatch.setattr('apostello.sending.time.sleep', lambda s: None)
+        client = FakeClient(rate_limited=sending.RATE_LIMITED_RETRIES + 1)
+        with pytest.raises(TwilioRestException):
+            sending.create_message(client, 'test', '+447927401749', '+447922537999')
+
+    def test_paced_by_bucket(self, monkeypatch):
+        reserved = []
+
+        class Bucket:
+            def wait(self):
+                reserved.append(1)
+
+        sending.create_message(FakeClient(), 'test', '+447927401749', '+447922537999', bucket=Bucket())
+        assert reserved == [1]
+
+
+@pytest.fixture
+def queued(recipients, groups):
+    now = timezone.now()
+    due = [
+        QueuedSms.objects.create(
+            time_to_send=now - timedelta(minutes=1),
+            content='Hi %name%',
+            sent_by='test',
+            recipient=recipients[name],
+            recipient_group=groups['test_group'],
+        ) for name in ['calvin', 'house_lamp', 'thomas_chalmers']
+    ]
+    later = QueuedSms.objects.create(
+        time_to_send=now + timedelta(hours=1),
+        content='later',
+        sent_by='test',
+        recipient=recipients['calvin'],
+    )
+    return {'due': due, 'later': later}
+
+
+@pytest.mark.django_db
+class TestQueuedDispatch:
+    def test_claim(self, queued):
+        pks = sending.claim_queued(2)
+        assert pks == [sms.pk for sms in queued['due'][:2]]
+        assert QueuedSms.objects.filter(claimed_at__isnull=False).count() == 2
+        # claimed rows are not handed out again
+        assert sending.claim_queued(10) == [queued['due'][2].pk]
+        assert sending.claim_queued(10) == []
+
+    def test_stale_claims_reclaimed(self, queued):
+        pks = sending.claim_queued(10)
+        later = timezone.now() + sending.STALE_CLAIM_AGE + timedelta(seconds=1)
+        assert sending.claim_queued(10, now=later) == pks
+
+    def test_dispatch_sends_due(self, queued, monkeypatch):
+        client = FakeClient(fail={str(queued['due'][2].recipient.number): 30003})
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        assert sending.dispatch_queued() == 3
+        assert sorted(m['body'] for m in client.messages.sent) == ['Hi Johannes', 'Hi John']
+        assert SmsOutbound.objects.count() == 2
+        assert set(SmsOutbound.objects.values_list('recipient_group', flat=True)) == {
+            queued['due'][0].recipient_group_id
+        }
+        assert set(QueuedSms.objects.filter(sent=True).values_list('pk', flat=True)) == {
+            sms.pk for sms in queued['due'][:2]
+        }
+        assert QueuedSms.objects.get(failed=True).pk == queued['due'][2].pk
+        assert not QueuedSms.objects.get(pk=queued['later'].pk).sent
+
+    def test_sent_once(self, queued, monkeypatch):
+        client = FakeClient()
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        pks = [sms.pk for sms in queued['due']]
+        sending.send_queued(pks)
+        sending.send_queued(pks)
+        assert len(client.messages.sent) == 3
+
+    def test_only_claim_holder_sends(self, queued, monkeypatch):
+        client = FakeClient()
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        first = timezone.now()
+        pks = sending.claim_queued(10, now=first)
+        later = first + sending.STALE_CLAIM_AGE + timedelta(seconds=1)
+        assert sending.claim_queued(10, now=later) == pks
+        assert sending.send_queued(pks, first) == {'sent': 0, 'failed': 0}
+        assert client.messages.sent == []
+        assert sending.send_queued(pks, later) == {'sent': 3, 'failed': 0}
+
+    def test_batch_written_in_bulk(self, queued, monkeypatch):
+        client = FakeClient(fail={str(queued['due'][2].recipient.number): 30003})
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        pks = [sms.pk for sms in queued['due']]
+        claimed_at = timezone.now()
+        QueuedSms.objects.filter(pk__in=pks).update(claimed_at=claimed_at)
+        with CaptureQueriesContext(connection) as queries:
+            assert sending.send_queued(pks, claimed_at) == {'sent': 2, 'failed': 1}
+        writes = [q['sql'] for q in queries if q['sql'].startswith(('INSERT', 'UPDATE'))]
+        table = QueuedSms._meta.db_table
+        # one insert for the log, one update per outcome, however big the batch
+        assert len([sql for sql in writes if sql.startswith('INSERT')]) == 1
+        assert len([sql for sql in writes if sql.startswith('UPDATE "{0}"'.format(table))]) == 2
+
+
+@pytest.mark.django_db
+class TestScheduledGroupSend:
+    def test_stored_once(self, groups, django_assert_num_queries):
+        eta = timezone.now() + timedelta(hours=1)
+        with django_assert_num_queries(2):
+            group_send_message_task('Hi %name%', 'Test Group', 'test', eta)
+        sms = QueuedSms.objects.get()
+        assert sms.recipient is None
+        assert sms.recipient_group == groups['test_group']
+        assert sms.recipient_count == 2
+
+    def test_members_resolved_when_sent(self, groups, recipients, monkeypatch):
+        client = FakeClient()
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        group_send_message_task('Hi %name%', 'Test Group', 'test', timezone.now() - timedelta(minutes=1))
+        groups['test_group'].recipient_set.add(recipients['unknown'])
+
+        sending.dispatch_queued()
+        assert sorted(m['body'] for m in client.messages.sent) == ['Hi Johannes', 'Hi John', 'Hi Unknown']
+        assert QueuedSms.objects.get().sent
+        assert SendJob.objects.get().status == SendJob.COMPLETE
+        # handed off once only
+        sending.send_queued(list(QueuedSms.objects.values_list('pk', flat=True)))
+        assert SendJob.objects.count() == 1
+
+    def test_api_lists_counts(self, groups, recipients, users):
+        eta = timezone.now() + timedelta(hours=1)
+        group_send_message_task('Hi %name%', 'Test Group', 'test', eta)
+        recipients['calvin'].send_message('Hi', sent_by='test', eta=eta)
+        resp = users['c_staff'].get('/api/v2/queued/sms/')
+        assert resp.status_code == 200
+        results = sorted(resp.json()['results'], key=lambda x: x['recipient'] is None)
+        assert [r['recipient_count'] for r in results] == [1, 2]
+        assert results[1]['recipient'] is None
+        assert results[1]['recipient_group']['name'] == 'Test Group'
+        assert 'members' not in results[1]['recipient_group']
+
+
+@pytest.mark.skipif(
+    not connection.features.has_select_for_update_skip_locked, reason='database does not support SKIP LOCKED'
+)
+@pytest.mark.django_db(transaction=True)
+def test_claim_skips_locked_rows(queued):
+    locked = threading.Event()
+    done = threading.Event()
+
+    def hold_lock():
+        with transaction.atomic():
+            list(QueuedSms.objects.select_for_update().filter(pk=queued['due'][0].pk))
+            locked.set()
+            done.wait(5)
+        connection.close()
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    try:
+        locked.wait(5)
+        assert sending.claim_queued(10) == [sms.pk for sms in queued['due'][1:]]
+    finally:
+        done.set()
+        holder.join()
+
+
+@pytest.mark.slow
+@pytest.mark.django_db
+class TestConcurrentSend:
+    def send(self, settings, monkeypatch, recipients, concurrency):
+        settings.SMS_SEND_CONCURRENCY = concurrency
+        client = FakeClient()
+        client.messages = SlowMessages(latency=0.05)
+        monkeypatch.setattr('apostello.sending.get_twilio_client', lambda: client)
+        people = [
+            {'pk': recipients['calvin'].pk, 'first_name': 'John', 'number': '+4479274{0:05d}'.format(i)}
+            for i in range(40)
+        ]
+        sms, num_failed = sending.send_messages(people, 'Hi %name%', 'test')
+        assert (len(sms), num_failed) == (40, 0)
+        assert sorted(m['to'] for m in client.messages.sent) == sorted(p['number'] for p in people)
+        return client.messages.max_active
+
+    def test_serial(self, settings, monkeypatch, recipients):
+        assert self.send(settings, monkeypatch, recipients, concurrency=1) == 1
+
+    def test_concurrent(self, settings, monkeypatch, recipients):
+        assert 1 < self.send(settings, monkeypatch, recipients, concurrency=8) <= 8
@@ -72,6 +72,21 @@ class TestTasks:
 
         assert SmsInbound.objects.filter(content="New test message").count() == 1
 
+    @twilio_vcr
+    def test_process_inbound_isolates_stages(self, recipients, monkeypatch):
+        def broken_slack(*args):
+            raise Exception('slack is down')
+
+        monkeypatch.setattr('apostello.tasks.sms_to_slack', broken_slack)
+        calvin = recipients['calvin']
+        p = {'Body': 'Pipeline test message', 'MessageSid': 'thisisapipelineuuid', 'From': str(calvin.number)}
+        timings = process_inbound(p, timezone.now(), calvin.pk, Keyword.classify(p['Body']), False)
+
+        assert SmsInbound.objects.filter(content="Pipeline test message").count() == 1
+        assert list(timings.keys()) == [
+            'log_msg_in', 'sms_to_slack', 'blacklist_notify', 'ask_for_name', 'send_cloud_messages'
+        ]
+
     def test_warn_on_blacklist_receipt(self, recipients):
         blacklist_notify(recipients['wesley'].pk, 'stop it', 'stop')
 
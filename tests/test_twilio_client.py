@@ -0,0 +1,47 @@
+import pytest
+from django.core.cache import cache
+
+from apostello import twilio
+from site_config.models import SendingNumber, SiteConfiguration
+
+
+@pytest.mark.django_db
+class TestTwilioClient:
+    def test_client_reused(self):
+        assert twilio.get_twilio_client() is twilio.get_twilio_client()
+
+    def test_rebuilt_on_new_credentials(self):
+        client = twilio.get_twilio_client()
+        config = SiteConfiguration.get_solo()
+        config.twilio_auth_token = 'a' * 32
+        config.save()
+        new_client = twilio.get_twilio_client()
+        assert new_client is not client
+        assert new_client.password == 'a' * 32
+
+    def test_pooled_session(self, settings):
+        settings.TWILIO_HTTP_POOL_SIZE = 3
+        settings.SMS_SEND_CONCURRENCY = 1
+        config = SiteConfiguration.get_solo()
+        config.twilio_auth_token = 'b' * 32
+        config.save()
+        client = twilio.get_twilio_client()
+        assert isinstance(client.http_client, twilio.PooledHttpClient)
+        adapter = client.http_client.session.get_adapter('https://api.twilio.com')
+        assert adapter._pool_maxsize == 3
+
+    def test_pool_covers_send_threads(self, settings):
+        settings.TWILIO_HTTP_POOL_SIZE = 3
+        settings.SMS_SEND_CONCURRENCY = 4
+        cache.delete('sending_numbers')
+        config = SiteConfiguration.get_solo()
+        config.twilio_from_num = '+447922537999'
+        config.save()
+        assert twilio.http_pool_size() == 4
+        client = twilio.get_twilio_client()
+
+        SendingNumber.objects.create(number='+447922537001')
+        assert twilio.http_pool_size() == 8
+        new_client = twilio.get_twilio_client()
+        assert new_client is not client
+        assert new_client.http_client.session.get_adapter('https://api.twilio.com')._pool_maxsize == 8
@@ -17,9 +17,11 @@ StatusCode = namedtuple('StatusCode', 'anon, user, staff')
         ('/api/v2/elvanto/groups/', StatusCode(403, 403, 200)),
         ('/api/v2/groups/', StatusCode(403, 200, 200)),
         ('/api/v2/keywords/', StatusCode(403, 200, 200)),
+        ('/api/v2/logs/sync/', StatusCode(403, 403, 200)),
         ('/api/v2/queued/sms/', StatusCode(403, 403, 200)),
         ('/api/v2/recipients/', StatusCode(403, 200, 200)),
         ('/api/v2/responses/', StatusCode(403, 403, 200)),
+        ('/api/v2/send_jobs/', StatusCode(403, 403, 200)),
         ('/api/v2/setup/', StatusCode(403, 403, 200)),
         ('/api/v2/sms/in/', StatusCode(403, 200, 200)),
         ('/api/v2/sms/out/', StatusCode(403, 200, 200)),